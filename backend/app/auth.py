@@ -1,13 +1,20 @@
+import asyncio
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone as tz
+from typing import NamedTuple
 from fastapi import HTTPException, Depends
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import jwt, JWTError
-import requests
+import httpx
 from fastapi.responses import RedirectResponse
 
-from database import User, SessionLocal
+import leaderboard
+from database import User, AsyncSessionLocal
+from plates import plate_index
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -16,46 +23,198 @@ GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 GOOGLE_REDIRECT_URI = os.environ.get('GOOGLE_REDIRECT_URI')
 
+# overridable so the OAuth flow can be pointed at a local stand-in server
+GOOGLE_AUTH_URL = os.environ.get("GOOGLE_AUTH_URL", "https://accounts.google.com/o/oauth2/auth")
+GOOGLE_TOKEN_URL = os.environ.get("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+GOOGLE_JWKS_URL = os.environ.get("GOOGLE_JWKS_URL", "https://www.googleapis.com/oauth2/v3/certs")
+GOOGLE_ISSUERS = os.environ.get("GOOGLE_ISSUERS", "https://accounts.google.com,accounts.google.com").split(",")
+OAUTH_HTTP_TIMEOUT = float(os.environ.get("OAUTH_HTTP_TIMEOUT", "5"))  # seconds
+JWKS_REFRESH_INTERVAL = int(os.environ.get("JWKS_REFRESH_INTERVAL", "3600"))  # seconds
 
-def get_db():
-    db = SessionLocal()
-    try:
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = int(os.environ.get("AUTH_CACHE_TTL", "300"))  # seconds, tokens never outlive their exp claim
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+class Principal(NamedTuple):
+    """The user a bearer token was issued to."""
+    id: int
+    email: str
+
+
+# token -> (expiry as a unix timestamp, principal), least recently used first
+_principals: OrderedDict[str, tuple[float, Principal]] = OrderedDict()
+
+
+def _cache_principal(token: str, principal: Principal, exp: float):
+    _principals[token] = (min(time.time() + AUTH_CACHE_TTL, exp), principal)
+    _principals.move_to_end(token)
+    if len(_principals) > AUTH_CACHE_SIZE:
+        _principals.popitem(last=False)
+
+
+def invalidate_principal(user_id: int):
+    """Drop every cached token of a user, so their next request sees the database again."""
+    for token in [token for token, (_, principal) in _principals.items() if principal.id == user_id]:
+        del _principals[token]
+
+
+async def get_principal(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
+    """
+    Resolve a bearer token to the user it belongs to. Verified tokens are cached until they expire or
+    AUTH_CACHE_TTL passes, whichever comes first, so most authenticated requests skip both the signature check
+    and the user lookup.
+    """
+    cached = _principals.get(token)
+    if cached is not None:
+        expires_at, principal = cached
+        if expires_at > time.time():
+            _principals.move_to_end(token)
+            return principal
+        del _principals[token]
+
+    try:
+        payload = jwt.decode(token, GOOGLE_CLIENT_SECRET, algorithms=["HS256"])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token", headers={"WWW-Authenticate": "Bearer"})
+
+    user = await db.get(User, int(payload["sub"]))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    principal = Principal(id=user.id, email=user.email)
+    _cache_principal(token, principal, payload["exp"])
+    return principal
+
+
+_http_client: httpx.AsyncClient | None = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """One pooled client per process, so logins reuse open TLS connections to the provider."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=OAUTH_HTTP_TIMEOUT,
+                                         limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+class SigningKeys:
+    """
+    The provider's public keys for id_tokens. They are fetched on first use, refreshed every JWKS_REFRESH_INTERVAL
+    seconds, and refreshed early when a token is signed with a key that isn't known yet (key rotation).
+    """
+
+    def __init__(self, jwks_url: str):
+        self.jwks_url = jwks_url
+        self._keys = None
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _refresh(self, stale_before: float):
+        async with self._lock:
+            # another request may have refreshed the keys while this one waited
+            if self._fetched_at > stale_before:
+                return
+            response = await get_http_client().get(self.jwks_url)
+            response.raise_for_status()
+            self._keys = response.json()
+            self._fetched_at = time.monotonic()
+
+    async def get(self, kid: str | None) -> dict:
+        now = time.monotonic()
+        if self._keys is None or now - self._fetched_at > JWKS_REFRESH_INTERVAL:
+            await self._refresh(now - JWKS_REFRESH_INTERVAL)
+        elif kid is not None and all(key.get("kid") != kid for key in self._keys["keys"]):
+            await self._refresh(now)
+        return self._keys
+
+
+class OAuthProvider:
+    """An OpenID Connect provider that logins exchange authorization codes with, and the client registered there."""
+
+    def __init__(self, client_id: str, client_secret: str, redirect_uri: str, token_url: str, jwks_url: str,
+                 issuers: list[str]):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.token_url = token_url
+        self.issuers = issuers
+        self.signing_keys = SigningKeys(jwks_url)
+
+
+google = OAuthProvider(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI, GOOGLE_TOKEN_URL, GOOGLE_JWKS_URL,
+                       GOOGLE_ISSUERS)
+
+
+async def verify_id_token(id_token: str, access_token: str | None = None, provider: OAuthProvider = google) -> dict:
+    """Check an id_token's signature, audience, issuer and expiry locally and return its claims."""
+    try:
+        kid = jwt.get_unverified_header(id_token).get("kid")
+        return jwt.decode(id_token, await provider.signing_keys.get(kid), algorithms=["RS256"],
+                          audience=provider.client_id, issuer=provider.issuers, access_token=access_token)
+    except JWTError:
+        raise HTTPException(status_code=400, detail="Invalid id_token")
+    except httpx.HTTPError:
+        raise HTTPException(status_code=502, detail="Could not fetch the login provider's signing keys")
 
 
 async def login_google():
     return RedirectResponse(
-        url=f"https://accounts.google.com/o/oauth2/auth?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email&access_type=offline")
+        url=f"{GOOGLE_AUTH_URL}?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email&access_type=offline")
 
 
-async def auth_google(code: str, db: Session = Depends(get_db)):
-    token_url = "https://accounts.google.com/o/oauth2/token"
+async def verify_login(code: str, provider: OAuthProvider = google) -> dict:
+    """Exchange an authorization code for the verified claims of the user who logged in. No database access."""
     data = {
         "code": code,
-        "client_id": GOOGLE_CLIENT_ID,
-        "client_secret": GOOGLE_CLIENT_SECRET,
-        "redirect_uri": GOOGLE_REDIRECT_URI,
+        "client_id": provider.client_id,
+        "client_secret": provider.client_secret,
+        "redirect_uri": provider.redirect_uri,
         "grant_type": "authorization_code",
     }
-    response = requests.post(token_url, data=data)
-    access_token = response.json().get("access_token")
-    user_info = requests.get("https://www.googleapis.com/oauth2/v1/userinfo",
-                             headers={"Authorization": f"Bearer {access_token}"}).json()
+    try:
+        response = await get_http_client().post(provider.token_url, data=data)
+    except httpx.HTTPError:
+        raise HTTPException(status_code=502, detail="Could not reach the login provider")
+    if response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Invalid authorization code")
+    try:
+        tokens = response.json()
+        id_token = tokens["id_token"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=502, detail="The login provider did not return an id_token")
+    # the id_token carries the profile, so there is no separate userinfo request
+    user_info = await verify_id_token(id_token, tokens.get("access_token"), provider)
 
-    if user_info["hd"] != "athenian.org":
+    if user_info.get("hd") != "athenian.org":
         raise HTTPException(status_code=400, detail="Only Athenian emails are allowed")
+    return user_info
 
-    user = db.query(User).filter(User.email == user_info["email"]).first()
+
+async def auth_google(code: str, db: AsyncSession = Depends(get_db)):
+    user_info = await verify_login(code)
+
+    user = await db.scalar(select(User).where(User.email == user_info["email"]))
     if not user:
         email = user_info["email"]
         user = User(
-            email=email, username=email.split("@")[0] + str(hash(email)), plate_number=0, average_score=0.0,
+            email=email, username=email.split("@")[0] + str(hash(email)), plate_number="0", average_score=0.0,
             name=user_info["name"])
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
 
     return await generate_token(user)
 
@@ -71,25 +230,25 @@ async def generate_token(user):
     return {"access_token": token, "token_type": "bearer"}
 
 
-async def set_user_info(user_id: int, username: str = None, plate_number: str = None, db: Session = Depends(get_db),
-                        token: str = Depends(oauth2_scheme)):
-    payload = jwt.decode(token, GOOGLE_CLIENT_SECRET, algorithms=["HS256"])
-    user_email = payload["email"]
+async def set_user_info(user_id: int, username: str = None, plate_number: str = None,
+                        db: AsyncSession = Depends(get_db), principal: Principal = Depends(get_principal)):
+    if principal.id != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized to update this user")
 
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if user.email != user_email:
-        raise HTTPException(status_code=403, detail="Not authorized to update this user")
-
     if username is not None:
         user.username = username
     if plate_number is not None:
         user.plate_number = plate_number
 
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    invalidate_principal(user.id)
+    plate_index.update(user.id, user.plate_number)
+    # cached leaderboard rows carry the username
+    leaderboard.invalidate()
 
     return {
         "id": user.id,
@@ -99,8 +258,8 @@ async def set_user_info(user_id: int, username: str = None, plate_number: str =
     }
 
 
-async def get_user_info(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_user_info(user_id: int, db: AsyncSession = Depends(get_db)):
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -113,19 +272,9 @@ async def get_user_info(user_id: int, db: Session = Depends(get_db)):
     }
 
 
-async def get_user_id(token: str = Depends(oauth2_scheme)):
-    payload = jwt.decode(token, GOOGLE_CLIENT_SECRET, algorithms=["HS256"])
-    return payload["sub"]
-
+async def get_user_id(principal: Principal = Depends(get_principal)):
+    return str(principal.id)
 
-async def refresh_token(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    try:
-        payload = jwt.decode(token, GOOGLE_CLIENT_SECRET, algorithms=["HS256"])
-        user_id = payload["sub"]
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
 
-        return generate_token(user)
-    except JWTError:
-        raise HTTPException(status_code=400, detail="Invalid token")
+async def refresh_token(principal: Principal = Depends(get_principal)):
+    return await generate_token(principal)
@@ -0,0 +1,53 @@
+class BKTree:
+    """
+    Burkhard-Keller tree: finds every key within a given distance of a query under any metric (Hamming distance
+    between image hashes, edit distance between plates, ...) while only visiting a small part of the tree.
+
+    Each key can carry any number of values.
+    """
+
+    def __init__(self, distance):
+        self.distance = distance
+        self._root = None  # [key, values, {distance: child}]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, value):
+        if self._root is None:
+            self._root = [key, [value], {}]
+            self._size += 1
+            return
+        node = self._root
+        while True:
+            d = self.distance(key, node[0])
+            if d == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, [value], {}]
+                self._size += 1
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """Return (distance, key, values) for every key within max_distance of `key`, closest first."""
+        found = [(d, node_key, list(values)) for d, (node_key, values) in self._walk(key, max_distance)]
+        found.sort(key=lambda match: match[0])
+        return found
+
+    def _walk(self, key, max_distance):
+        if self._root is None:
+            return
+        stack = [self._root]
+        while stack:
+            node_key, values, children = stack.pop()
+            d = self.distance(key, node_key)
+            if d <= max_distance:
+                yield d, (node_key, values)
+            # by the triangle inequality only children at distance d +- max_distance can hold matches
+            for child_distance, child in children.items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
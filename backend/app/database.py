@@ -1,39 +1,198 @@
-from sqlalchemy import create_engine, Column, Integer, LargeBinary, URL, String, ForeignKey, Float
+import asyncio
+import os
+
+from sqlalchemy import (create_engine, Column, Integer, LargeBinary, URL, String, ForeignKey, Float, text,
+                        PrimaryKeyConstraint, DateTime, Index, func, BigInteger, SmallInteger, REAL)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship, Mapped
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import sessionmaker, Session, relationship, Mapped, deferred
 
 url = URL.create(
     "postgresql",
-    username="dbuser",
-    password="dbpassword",
-    port=5432,
-    host="postgres-service",
-    database="db"
+    username=os.environ.get("DB_USER", "dbuser"),
+    password=os.environ.get("DB_PASSWORD", "dbpassword"),
+    port=int(os.environ.get("DB_PORT", "5432")),
+    host=os.environ.get("DB_HOST", "postgres-service"),
+    database=os.environ.get("DB_NAME", "db")
 )
 
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))  # seconds
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "30"))  # seconds to wait for a free connection
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", "10000"))  # milliseconds, 0 disables it
+# whether the API and the worker create and upgrade the schema when they start, instead of only `manage.py migrate`
+DB_MIGRATE_ON_STARTUP = os.environ.get("DB_MIGRATE_ON_STARTUP", "1") == "1"
+
+# used by the management commands and schema setup
 engine = create_engine(url)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# used by the API routes
+async_engine = create_async_engine(
+    url.set(drivername="postgresql+asyncpg"),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    connect_args={"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT)}},
+)
+# objects stay usable after commit, since lazy loading isn't possible with an AsyncSession
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class User(Base):
     __tablename__ = "users"
+    # leaderboards page through users with posts, best first, see leaderboard.get_leaderboard
+    __table_args__ = (
+        Index("ix_users_score_sum_id", "score_sum", "id", postgresql_where=text("post_count > 0")),
+        Index("ix_users_average_score_id", "average_score", "id", postgresql_where=text("post_count > 0")),
+        Index("ix_users_best_score_id", "best_score", "id", postgresql_where=text("post_count > 0")),
+    )
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, unique=True, index=True)
     username: Mapped[str] = Column(unique=True)
     plate_number = Column(String(7))
-    posts: Mapped[list["Post"]] = relationship(back_populates="user")
-    pictured: Mapped[list["Post"]] = relationship(back_populates="pictured_user")
+    posts: Mapped[list["Post"]] = relationship(back_populates="user", foreign_keys="Post.user_id")
+    pictured: Mapped[list["Post"]] = relationship(back_populates="pictured_user", foreign_keys="Post.pictured_user_id")
+    # running aggregates over the user's posts, kept up to date by leaderboard.record_post
+    post_count: Mapped[int] = Column(Integer, nullable=False, default=0, server_default="0")
+    score_sum: Mapped[float] = Column(Float, nullable=False, default=0.0, server_default="0")
     average_score: Mapped[float] = Column()
+    best_score: Mapped[float] = Column(Float)
+    pictured_count: Mapped[int] = Column(Integer, nullable=False, default=0, server_default="0")  # posts they are in
     name: Mapped[str] = Column()
 
 class Post(Base):
     __tablename__ = "posts"
-    image = Column(LargeBinary, nullable=False)
+    # feeds page through posts newest first on (created_at, id); the included columns make these index-only scans
+    __table_args__ = (
+        Index("ix_posts_created_at_id", "created_at", "id",
+              postgresql_include=["user_id", "pictured_user_id", "score"]),
+        Index("ix_posts_user_id_created_at_id", "user_id", "created_at", "id",
+              postgresql_include=["pictured_user_id", "score"]),
+        Index("ix_posts_pictured_user_id_created_at_id", "pictured_user_id", "created_at", "id",
+              postgresql_include=["user_id", "score"]),
+    )
+    # legacy inline image, moved to the blob store by `manage.py migrate-images`. Deferred so loading a post
+    # never pulls it unless it is actually accessed
+    image = deferred(Column(LargeBinary))
+    image_key: Mapped[str] = Column(String(64))  # blob store key of the annotated image
+    image_size: Mapped[int] = Column(Integer)  # size of the annotated image in bytes
     id = Column(Integer, primary_key=True, index=True)
-    user: Mapped["User"] = relationship(back_populates="posts")  # user who posted
     user_id: Mapped[int] = Column(ForeignKey("users.id"))  # user who posted
-    score: Mapped[int] = Column()
-    pictured_user: Mapped["User"] = relationship(back_populates="pictured")  # user who is in the picture
+    user: Mapped["User"] = relationship(back_populates="posts", foreign_keys=[user_id])  # user who posted
+    score: Mapped[float] = Column(Float)  # unrounded, so the users' aggregates can be rebuilt exactly from it
+    pictured_user_id: Mapped[int] = Column(ForeignKey("users.id"))  # user who is in the picture
+    pictured_user: Mapped["User"] = relationship(back_populates="pictured",
+                                                 foreign_keys=[pictured_user_id])  # user who is in the picture
     pictured_plate_number: Mapped[str] = Column(String(7))  # license plate number in the picture
+    images: Mapped[list["PostImage"]] = relationship(back_populates="post")  # resized/re-encoded variants
+    detections: Mapped["PostDetections"] = relationship(back_populates="post")  # vehicles found in the image
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+class PostImage(Base):
+    __tablename__ = "post_images"
+    __table_args__ = (PrimaryKeyConstraint("post_id", "size", "format"),)
+    post_id: Mapped[int] = Column(ForeignKey("posts.id"))
+    post: Mapped["Post"] = relationship(back_populates="images")
+    size: Mapped[str] = Column(String(16))  # name of the size, see derivatives.IMAGE_SIZES
+    format: Mapped[str] = Column(String(8))  # "jpeg" or "webp"
+    image_key: Mapped[str] = Column(String(64), nullable=False)  # blob store key
+    image_size: Mapped[int] = Column(Integer)  # size in bytes
+    width: Mapped[int] = Column(Integer)
+    height: Mapped[int] = Column(Integer)
+
+class PostDetections(Base):
+    __tablename__ = "post_detections"
+    # the vehicles detected in a post's image, one array element per vehicle. Posts with a row store the plain photo
+    # as their images and are annotated on read, see render.py; older posts store the annotated image
+    post_id: Mapped[int] = Column(ForeignKey("posts.id"), primary_key=True)
+    post: Mapped["Post"] = relationship(back_populates="detections")
+    labels: Mapped[list[str]] = Column(ARRAY(String(16)), nullable=False)  # vehicle type, e.g. "car"
+    confidences: Mapped[list[float]] = Column(ARRAY(REAL), nullable=False)
+    # x center, y center, width and height of every vehicle as fractions of the image size, flattened
+    boxes: Mapped[list[float]] = Column(ARRAY(REAL), nullable=False)
+    colors: Mapped[list[str]] = Column(ARRAY(String))  # most likely color, null where not classified
+    makes: Mapped[list[str]] = Column(ARRAY(String))  # most likely make and model, null where not classified
+    rated: Mapped[int] = Column(SmallInteger)  # index of the vehicle the score is for
+
+class ImageHash(Base):
+    __tablename__ = "image_hashes"
+    post_id: Mapped[int] = Column(ForeignKey("posts.id"), primary_key=True)  # post made from the upload
+    sha256: Mapped[str] = Column(String(64), nullable=False, index=True)  # hash of the uploaded bytes
+    dhash: Mapped[int] = Column(BigInteger, nullable=False)  # perceptual hash, see dedup.dhash
+    # the in-memory index catches up on rows by this, see dedup.DuplicateIndex
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+
+class IngestJob(Base):
+    __tablename__ = "ingest_jobs"
+    # workers claim the oldest queued jobs, see worker.claim_jobs
+    __table_args__ = (Index("ix_ingest_jobs_status_id", "status", "id"),)
+    id = Column(Integer, primary_key=True)
+    user_id: Mapped[int] = Column(ForeignKey("users.id"), nullable=False)  # user who uploaded
+    status: Mapped[str] = Column(String(16), nullable=False, default="queued")  # queued, running, done or failed
+    upload_key: Mapped[str] = Column(String(64), nullable=False)  # blob store key of the uploaded image
+    attempts: Mapped[int] = Column(Integer, nullable=False, default=0)
+    post_id: Mapped[int] = Column(ForeignKey("posts.id"))  # set once the job is done
+    score: Mapped[float] = Column(Float)
+    plate_number: Mapped[str] = Column(String(7))
+    error: Mapped[str] = Column(String)
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
+
+# create_all only creates missing tables, so columns added to existing tables are applied here
+SCHEMA_UPGRADES = [
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS image_key VARCHAR(64)",
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS image_size INTEGER",
+    "ALTER TABLE posts ALTER COLUMN image DROP NOT NULL",
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS pictured_user_id INTEGER REFERENCES users (id)",
+    "ALTER TABLE posts ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    # scores used to be truncated to integers. Only retype once, ALTER TYPE locks the table even when it's a no-op
+    "DO $$ BEGIN IF (SELECT data_type FROM information_schema.columns WHERE table_name = 'posts' "
+    "AND column_name = 'score') <> 'double precision' THEN "
+    "ALTER TABLE posts ALTER COLUMN score TYPE DOUBLE PRECISION; END IF; END $$",
+    "CREATE INDEX IF NOT EXISTS ix_posts_created_at_id ON posts (created_at, id) "
+    "INCLUDE (user_id, pictured_user_id, score)",
+    "CREATE INDEX IF NOT EXISTS ix_posts_user_id_created_at_id ON posts (user_id, created_at, id) "
+    "INCLUDE (pictured_user_id, score)",
+    "CREATE INDEX IF NOT EXISTS ix_posts_pictured_user_id_created_at_id ON posts (pictured_user_id, created_at, id) "
+    "INCLUDE (user_id, score)",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS post_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS score_sum DOUBLE PRECISION NOT NULL DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS best_score DOUBLE PRECISION",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS pictured_count INTEGER NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS ix_users_score_sum_id ON users (score_sum, id) WHERE post_count > 0",
+    "CREATE INDEX IF NOT EXISTS ix_users_average_score_id ON users (average_score, id) WHERE post_count > 0",
+    "CREATE INDEX IF NOT EXISTS ix_users_best_score_id ON users (best_score, id) WHERE post_count > 0",
+    "ALTER TABLE image_hashes ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+    "CREATE INDEX IF NOT EXISTS ix_image_hashes_created_at ON image_hashes (created_at)",
+]
+
+
+def create_schema(connection):
+    """Create missing tables and apply SCHEMA_UPGRADES. Every statement is idempotent, so this is safe to rerun."""
+    Base.metadata.create_all(bind=connection)
+    for statement in SCHEMA_UPGRADES:
+        connection.execute(text(statement))
+
+
+def migrate():
+    with engine.begin() as connection:
+        create_schema(connection)
+
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+async def migrate_when_reachable(max_delay: float = 30.0):
+    """Run migrate, retrying with backoff while the database can't be reached instead of failing startup."""
+    delay = 1.0
+    while True:
+        try:
+            # on the sync engine, which has no statement timeout for building indexes
+            return await asyncio.to_thread(migrate)
+        except OperationalError as error:
+            print(f"database not reachable, retrying in {delay:.0f}s: {error.orig}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
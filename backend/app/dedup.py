@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from datetime import timedelta
+
+from PIL import Image
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bktree import BKTree
+from database import ImageHash
+
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1") == "1"
+DEDUP_MAX_DISTANCE = int(os.environ.get("DEDUP_MAX_DISTANCE", "6"))  # max Hamming distance between dHashes
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "10000"))
+# created_at is when the inserting transaction started, so a row can become visible after rows with a later
+# created_at. Catching up re-reads this far back, which must be longer than any transaction that saves a post
+DEDUP_CATCH_UP_OVERLAP = timedelta(seconds=int(os.environ.get("DEDUP_CATCH_UP_OVERLAP", "60")))
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def dhash(contents: bytes, hash_size: int = 8) -> int:
+    """Difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale copy of the image."""
+    image = Image.open(io.BytesIO(contents))
+    # JPEGs can be decoded straight at a fraction of their resolution
+    image.draft("L", (hash_size * 8, hash_size * 8))
+    pixels = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def compute_hashes(contents: bytes) -> tuple[str, int]:
+    """The exact (SHA-256) and perceptual (dHash) hash of an upload."""
+    return hashlib.sha256(contents).hexdigest(), dhash(contents)
+
+
+def _to_signed(value: int) -> int:
+    # dHashes are unsigned 64 bit, Postgres BIGINT is signed
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class DuplicateIndex:
+    """
+    Finds earlier posts made from the same or a nearly identical upload.
+
+    Exact matches go through an LRU of recent SHA-256 hashes in front of the indexed image_hashes table.
+    Near duplicates are found with a BK-tree over every dHash in that table, which is loaded on first use and
+    caught up with rows written by other processes before every lookup.
+    """
+
+    def __init__(self):
+        self._recent: OrderedDict[str, int] = OrderedDict()
+        self._tree = BKTree(hamming_distance)
+        self._loaded: set[int] = set()  # post ids already in the tree
+        self._last_created_at = None
+        self._lock = asyncio.Lock()
+
+    def _remember_exact(self, sha256: str, post_id: int):
+        self._recent[sha256] = post_id
+        self._recent.move_to_end(sha256)
+        if len(self._recent) > DEDUP_CACHE_SIZE:
+            self._recent.popitem(last=False)
+
+    def _add(self, post_id: int, sha256: str, perceptual_hash: int):
+        self._remember_exact(sha256, post_id)
+        self._tree.add(perceptual_hash, post_id)
+        self._loaded.add(post_id)
+
+    async def _catch_up(self, db: AsyncSession):
+        async with self._lock:
+            query = select(ImageHash.post_id, ImageHash.sha256, ImageHash.dhash, ImageHash.created_at)
+            if self._last_created_at is not None:
+                # not by post id: other processes can commit a lower id after a higher one was loaded
+                query = query.where(ImageHash.created_at > self._last_created_at - DEDUP_CATCH_UP_OVERLAP)
+            rows = (await db.execute(query.order_by(ImageHash.created_at))).all()
+            for row in rows:
+                if row.post_id not in self._loaded:
+                    self._add(row.post_id, row.sha256, _to_unsigned(row.dhash))
+            if rows:
+                self._last_created_at = rows[-1].created_at
+
+    async def find(self, db: AsyncSession, sha256: str, perceptual_hash: int) -> int | None:
+        """Id of the post with the same or the closest similar image, if there is one."""
+        post_id = self._recent.get(sha256)
+        if post_id is not None:
+            self._recent.move_to_end(sha256)
+            return post_id
+
+        await self._catch_up(db)
+        post_id = self._recent.get(sha256)
+        if post_id is None:
+            post_id = await db.scalar(select(ImageHash.post_id).where(ImageHash.sha256 == sha256).limit(1))
+        if post_id is not None:
+            self._remember_exact(sha256, post_id)
+            return post_id
+
+        matches = self._tree.search(perceptual_hash, DEDUP_MAX_DISTANCE)
+        if matches:
+            _, _, post_ids = matches[0]
+            return min(post_ids)
+        return None
+
+    def record(self, db: AsyncSession, post_id: int, sha256: str, perceptual_hash: int):
+        """
+        Add the hashes of a new post to the session, to be committed together with the post. The in-memory index
+        picks them up on the next lookup that misses the LRU.
+        """
+        db.add(ImageHash(post_id=post_id, sha256=sha256, dhash=_to_signed(perceptual_hash)))
+
+
+duplicate_index = DuplicateIndex()
@@ -0,0 +1,57 @@
+import io
+import os
+
+from PIL import Image
+
+
+def _parse_sizes(value: str) -> dict[str, int | None]:
+    # "thumbnail:256,medium:1024,full" -> {"thumbnail": 256, "medium": 1024, "full": None}
+    sizes = {}
+    for entry in value.split(","):
+        name, _, max_side = entry.strip().partition(":")
+        sizes[name] = int(max_side) if max_side else None
+    return sizes
+
+
+# size name -> longest side in pixels, None keeps the original resolution
+IMAGE_SIZES = _parse_sizes(os.environ.get("IMAGE_SIZES", "thumbnail:256,medium:1024,full"))
+IMAGE_FORMATS = os.environ.get("IMAGE_FORMATS", "jpeg,webp").split(",")
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+
+DEFAULT_SIZE = "full"
+DEFAULT_FORMAT = "jpeg"
+
+MEDIA_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+_PIL_FORMATS = {
+    "jpeg": "JPEG",
+    "webp": "WEBP",
+}
+
+
+def make_derivatives(image_bytes: bytes) -> list[tuple[str, str, bytes, int, int]]:
+    """
+    Produce every configured (size, format) variant of a JPEG image.
+
+    Returns (size, format, data, width, height) tuples. The full size JPEG is the input itself, so it is
+    never re-encoded.
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    derivatives = []
+    for size, max_side in IMAGE_SIZES.items():
+        resized = image
+        if max_side is not None and max(image.size) > max_side:
+            resized = image.copy()
+            resized.thumbnail((max_side, max_side), Image.LANCZOS)
+        for image_format in IMAGE_FORMATS:
+            if resized is image and image_format == "jpeg":
+                data = image_bytes
+            else:
+                buffer = io.BytesIO()
+                resized.save(buffer, format=_PIL_FORMATS[image_format], quality=IMAGE_QUALITY)
+                data = buffer.getvalue()
+            derivatives.append((size, image_format, data, resized.width, resized.height))
+    return derivatives
@@ -0,0 +1,76 @@
+import io
+import os
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+# longest side of the frame ANPR reads plates from, plates are small so this stays close to the camera resolution.
+# It is also the resolution posts are stored at, see encode_full
+ANPR_MAX_SIDE = int(os.environ.get("ANPR_MAX_SIDE", "2560"))
+# longest side of the frame vehicles are detected, classified and annotated on. YOLO letterboxes to 640 and the
+# classifiers take 224 pixel crops, so anything much larger is decoded and copied for nothing
+FRAME_MAX_SIDE = int(os.environ.get("FRAME_MAX_SIDE", "1280"))
+
+
+class Frame:
+    """
+    An upload decoded once, upright, at the resolutions the models need.
+
+    `full` (for ANPR) and `small` (for vehicle detection and classification) are BGR like everything OpenCV and
+    ultralytics produce, `rgb` is a view of `full` for the models that expect RGB. When the upload is already
+    small enough `small` is `full` itself.
+    """
+
+    def __init__(self, full: np.ndarray, small: np.ndarray):
+        self.full = full
+        self.small = small
+        self.scale = small.shape[1] / full.shape[1]  # small pixels per full pixel
+
+    @property
+    def rgb(self) -> np.ndarray:
+        return self.full[:, :, ::-1]
+
+    def rgb_roi(self, x: float, y: float, width: float, height: float, padding: float = 0.0) -> np.ndarray:
+        """
+        View of the part of `rgb` under a box given as center and size in `small` coordinates, grown by `padding`
+        times its size on every side and clipped to the frame.
+        """
+        x, y, width, height = (value / self.scale for value in (x, y, width, height))
+        half_width, half_height = width * (0.5 + padding), height * (0.5 + padding)
+        frame_height, frame_width = self.full.shape[:2]
+        left, right = max(0, int(x - half_width)), min(frame_width, int(x + half_width))
+        top, bottom = max(0, int(y - half_height)), min(frame_height, int(y + half_height))
+        return self.rgb[top:bottom, left:right]
+
+
+def _fit(size: tuple[int, int], max_side: int) -> tuple[int, int]:
+    width, height = size
+    ratio = min(1.0, max_side / max(width, height))
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def decode_frame(contents: bytes) -> Frame:
+    image = Image.open(io.BytesIO(contents))
+    # JPEGs are decoded straight at a power of two fraction of their resolution when that is still large enough,
+    # other formats ignore this
+    image.draft("RGB", _fit(image.size, ANPR_MAX_SIDE))
+    # phones store portrait photos sideways and record the rotation in EXIF
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) > ANPR_MAX_SIDE:
+        image = image.resize(_fit(image.size, ANPR_MAX_SIDE), Image.BILINEAR, reducing_gap=2.0)
+
+    full = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+    small = full
+    if max(full.shape[:2]) > FRAME_MAX_SIDE:
+        width, height = _fit((full.shape[1], full.shape[0]), FRAME_MAX_SIDE)
+        small = cv2.resize(full, (width, height), interpolation=cv2.INTER_AREA)
+    return Frame(full, small)
+
+
+def encode_full(frame: Frame, quality: int) -> bytes:
+    """`full` as a JPEG, the image a post stores. Detections are stored relative to the image size, so they fit it."""
+    _, buffer = cv2.imencode(".jpg", frame.full, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
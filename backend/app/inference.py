@@ -0,0 +1,139 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+import model_registry
+
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")  # "thread" or "process"
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "2"))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "16"))
+INFERENCE_RETRY_AFTER = int(os.environ.get("INFERENCE_RETRY_AFTER", "5"))  # seconds
+
+
+class _Timings:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+_executor: Executor | None = None
+_warm = False  # every model the inference executor uses is loaded and warmed up
+_admitted = 0  # requests holding an admission slot, queued or running
+_queued = 0  # tasks submitted to the executor that are waiting or running
+_rejected = 0
+_wait_times = _Timings()
+_run_times = _Timings()
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if INFERENCE_EXECUTOR == "process":
+            # every worker process loads its own copy of the models. They are spawned rather than forked, since
+            # TensorFlow sessions and PyTorch/OpenMP thread pools don't survive a fork
+            _executor = ProcessPoolExecutor(max_workers=INFERENCE_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=model_registry.load_models)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+    return _executor
+
+
+def shutdown():
+    global _executor, _warm
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _warm = False
+
+
+async def warm_up():
+    """
+    Load and warm up the models wherever inference runs: in this process for the thread executor, in every worker
+    process (and not in this one) for the process executor.
+    """
+    global _warm
+    loop = asyncio.get_running_loop()
+    if INFERENCE_EXECUTOR == "process":
+        # the pool starts a worker per task while none is idle, and each runs load_models before its first task
+        await asyncio.gather(*(loop.run_in_executor(get_executor(), model_registry.models_loaded)
+                               for _ in range(INFERENCE_WORKERS)))
+    else:
+        await loop.run_in_executor(None, model_registry.load_models)
+    _warm = True
+
+
+def is_warm() -> bool:
+    return _warm
+
+
+@asynccontextmanager
+async def admission():
+    """
+    Reserve one of the INFERENCE_QUEUE_SIZE slots for the duration of a request's inference work,
+    rejecting the request with a 503 when all of them are taken.
+    """
+    global _admitted, _rejected
+    if _admitted >= INFERENCE_QUEUE_SIZE:
+        _rejected += 1
+        raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                            headers={"Retry-After": str(INFERENCE_RETRY_AFTER)})
+    _admitted += 1
+    try:
+        yield
+    finally:
+        _admitted -= 1
+
+
+def _timed_call(fn, *args):
+    # time.monotonic is system-wide, so it is comparable across worker processes
+    started = time.monotonic()
+    result = fn(*args)
+    return started, time.monotonic(), result
+
+
+async def run(fn, *args):
+    """Run a blocking inference function on the inference executor and await its result."""
+    global _queued
+    loop = asyncio.get_running_loop()
+    submitted = time.monotonic()
+    _queued += 1
+    future = loop.run_in_executor(get_executor(), _timed_call, fn, *args)
+    try:
+        started, finished, result = await future
+    finally:
+        _queued -= 1
+    _wait_times.record(started - submitted)
+    _run_times.record(finished - started)
+    return result
+
+
+def get_metrics():
+    return {
+        "executor": INFERENCE_EXECUTOR,
+        "workers": INFERENCE_WORKERS,
+        "queue_size": INFERENCE_QUEUE_SIZE,
+        "admitted": _admitted,
+        "queue_depth": _queued,
+        "rejected": _rejected,
+        "wait_time": _wait_times.as_dict(),
+        "run_time": _run_times.as_dict(),
+    }
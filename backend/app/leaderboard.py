@@ -0,0 +1,119 @@
+import base64
+import binascii
+import os
+import time
+
+from fastapi import HTTPException, Depends
+from sqlalchemy import select, update, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Post, User
+
+LEADERBOARD_PAGE_SIZE = int(os.environ.get("LEADERBOARD_PAGE_SIZE", "20"))
+LEADERBOARD_MAX_PAGE_SIZE = int(os.environ.get("LEADERBOARD_MAX_PAGE_SIZE", "100"))
+LEADERBOARD_CACHE_SIZE = int(os.environ.get("LEADERBOARD_CACHE_SIZE", "100"))  # top rows kept per ordering
+# other replicas don't see this process's invalidations, this bounds how stale their cached top rows can get
+LEADERBOARD_CACHE_TTL = int(os.environ.get("LEADERBOARD_CACHE_TTL", "30"))  # seconds
+
+# leaderboard ordering -> users column, each backed by a partial index, see database.User
+METRICS = {
+    "total": User.score_sum,
+    "average": User.average_score,
+    "best": User.best_score,
+}
+
+# ordering -> (time fetched, top rows)
+_top: dict[str, tuple[float, list]] = {}
+
+
+def invalidate():
+    _top.clear()
+
+
+async def record_post(db: AsyncSession, post: Post):
+    """
+    Fold a new post into its users' running aggregates, in the transaction that inserts the post. All SET
+    expressions see the row as it was before the update, so the new average uses the old sum and count.
+    """
+    await db.execute(
+        update(User)
+        .where(User.id == post.user_id)
+        .values(post_count=User.post_count + 1,
+                score_sum=User.score_sum + post.score,
+                average_score=(User.score_sum + post.score) / (User.post_count + 1),
+                best_score=func.greatest(func.coalesce(User.best_score, post.score), post.score))
+        .execution_options(synchronize_session=False)
+    )
+    if post.pictured_user_id is not None:
+        await db.execute(
+            update(User)
+            .where(User.id == post.pictured_user_id)
+            .values(pictured_count=User.pictured_count + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def encode_leaderboard_cursor(value: float, user_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{value!r}|{user_id}".encode()).decode()
+
+
+def decode_leaderboard_cursor(cursor: str) -> tuple[float, int]:
+    try:
+        value, user_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return float(value), int(user_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def query_leaderboard(db: AsyncSession, metric, cursor: str | None, limit: int) -> list:
+    query = (select(User.id, User.username, User.name, User.post_count, User.score_sum, User.average_score,
+                    User.best_score, User.pictured_count)
+             .where(User.post_count > 0))
+    if cursor is not None:
+        query = query.where(tuple_(metric, User.id) < decode_leaderboard_cursor(cursor))
+    return (await db.execute(query.order_by(metric.desc(), User.id.desc()).limit(limit))).all()
+
+
+async def get_leaderboard(by: str = "total", cursor: str = None, limit: int = LEADERBOARD_PAGE_SIZE,
+                          db: AsyncSession = Depends()):
+    """
+    Users with at least one post, best first. Pages are keyed on (metric, id) and read backwards along the
+    metric's index, so a page costs the same however many users and posts there are. The top rows of every
+    ordering are cached until the next post is written.
+    """
+    if by not in METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown ordering, expected one of {', '.join(METRICS)}")
+    metric = METRICS[by]
+    limit = max(1, min(limit, LEADERBOARD_MAX_PAGE_SIZE))
+
+    # fetch one extra row to know whether there is a next page
+    if cursor is None and limit < LEADERBOARD_CACHE_SIZE:
+        cached = _top.get(by)
+        if cached is None or time.monotonic() - cached[0] > LEADERBOARD_CACHE_TTL:
+            cached = (time.monotonic(), await query_leaderboard(db, metric, None, LEADERBOARD_CACHE_SIZE))
+            _top[by] = cached
+        rows = cached[1][:limit + 1]
+    else:
+        rows = await query_leaderboard(db, metric, cursor, limit + 1)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_leaderboard_cursor(getattr(last, metric.key), last.id)
+    return {
+        "users": [
+            {
+                "id": row.id,
+                "username": row.username,
+                "name": row.name,
+                "postCount": row.post_count,
+                "scoreSum": row.score_sum,
+                "averageScore": row.average_score,
+                "bestScore": row.best_score,
+                "picturedCount": row.pictured_count,
+            }
+            for row in rows
+        ],
+        "nextCursor": next_cursor,
+    }
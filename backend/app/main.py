@@ -1,21 +1,71 @@
-from fastapi import FastAPI, Depends, UploadFile, File, Form
+import asyncio
+import traceback
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Depends, UploadFile, File, Form, Query
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import inference
+import leaderboard
+from database import async_engine, migrate_when_reachable, DB_MIGRATE_ON_STARTUP
+from derivatives import DEFAULT_SIZE, DEFAULT_FORMAT
+from auth import (login_google, auth_google, set_user_info, refresh_token, get_user_id, get_user_info, get_db,
+                  get_principal, Principal, close_http_client)
+from posts import (create_post, get_post, get_post_info, get_user_posts, get_recent_post_id, get_feed, get_user_feed,
+                   get_pictured_feed, get_ingest_job, FEED_PAGE_SIZE, FEED_MAX_PAGE_SIZE, INGEST_MODE)
+
+_startup = {"schema": False, "error": None}
+
+
+async def warm_up():
+    """Bring the schema up to date and load the models, in the background so the server answers right away."""
+    if DB_MIGRATE_ON_STARTUP:
+        await migrate_when_reachable()
+    _startup["schema"] = True
+    # with async ingest the workers run every inference, so the API never loads the models
+    if INGEST_MODE == "sync":
+        await inference.warm_up()
+
+
+def _warm_up_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        traceback.print_exception(task.exception())
+        _startup["error"] = repr(task.exception())
 
-from database import SessionLocal
-from auth import login_google, auth_google, set_user_info, refresh_token, get_user_id, get_user_info
-from posts import create_post, get_post, get_post_info, get_user_posts, get_recent_post_id
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_up_task = asyncio.create_task(warm_up())
+    warm_up_task.add_done_callback(_warm_up_done)
+    yield
+    warm_up_task.cancel()
+    inference.shutdown()
+    await async_engine.dispose()
+    await close_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.get("/healthz")
+async def healthz_route():
+    # a failed warm-up won't recover by itself, so have the pod restarted
+    if _startup["error"] is not None:
+        return JSONResponse({"status": "failed", "error": _startup["error"]}, status_code=503)
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz_route():
+    status = {"schema": _startup["schema"]}
+    if INGEST_MODE == "sync":
+        status["models"] = inference.is_warm()
+    if not all(status.values()):
+        return JSONResponse({"status": "starting", **status}, status_code=503)
+    return {"status": "ready", **status}
 
 
 @app.get("/login/google")
@@ -24,29 +74,36 @@ async def login_google_route():
 
 
 @app.get("/auth/google")
-async def auth_google_route(code: str, db: Session = Depends(get_db)):
+async def auth_google_route(code: str, db: AsyncSession = Depends(get_db)):
     return await auth_google(code, db)
 
 @app.get("/auth/get_user_id")
-async def get_user_id_route(token: str = Depends(oauth2_scheme)):
-    return await get_user_id(token)
+async def get_user_id_route(principal: Principal = Depends(get_principal)):
+    return await get_user_id(principal)
 
 
 @app.post("/user/{user_id}")
 async def set_user_info_route(user_id: int, username: str = None, plate_number: str = None,
-                              db: Session = Depends(get_db),
-                              token: str = Depends(oauth2_scheme)):
-    return await set_user_info(user_id, username, plate_number, db, token)
+                              db: AsyncSession = Depends(get_db),
+                              principal: Principal = Depends(get_principal)):
+    return await set_user_info(user_id, username, plate_number, db, principal)
 
 
 @app.get("/users/get_user_info/{user_id}")
-async def get_user_info_route(user_id: int, db: Session = Depends(get_db)):
+async def get_user_info_route(user_id: int, db: AsyncSession = Depends(get_db)):
     return await get_user_info(user_id, db)
 
 
 @app.post("/posts/")
-async def create_post_route(file: UploadFile = File(...), db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    return await create_post(file, db, token)
+async def create_post_route(file: UploadFile = File(...), db: AsyncSession = Depends(get_db),
+                            principal: Principal = Depends(get_principal)):
+    return await create_post(file, db, principal)
+
+
+@app.get("/posts/jobs/{job_id}")
+async def get_ingest_job_route(job_id: int, db: AsyncSession = Depends(get_db),
+                               principal: Principal = Depends(get_principal)):
+    return await get_ingest_job(job_id, db, principal)
 
 
 @app.get("/token")
@@ -54,26 +111,61 @@ async def get_token_route(token: str = Depends(oauth2_scheme)):
     return {"token": token}
 
 
+@app.get("/posts/recent_id")
+async def get_recent_post_id_route(db: AsyncSession = Depends(get_db)):
+    return await get_recent_post_id(db)
+
+
 @app.get("/posts/{post_id}")
-async def get_post_route(post_id: int, db: Session = Depends(get_db)):
-    return await get_post(post_id, db)
+async def get_post_route(post_id: int, size: str = DEFAULT_SIZE, format: str = DEFAULT_FORMAT,
+                         annotated: bool = True, db: AsyncSession = Depends(get_db)):
+    return await get_post(post_id, size, format, annotated, db)
 
 
 @app.get("/posts/info/{post_id}")
-async def get_post_info_route(post_id: int, db: Session = Depends(get_db)):
-    return await get_post_info(post_id, db)
+async def get_post_info_route(post_id: int, size: str = DEFAULT_SIZE, format: str = DEFAULT_FORMAT,
+                              include_image: bool = True, db: AsyncSession = Depends(get_db)):
+    return await get_post_info(post_id, size, format, include_image, db)
 
 
 @app.get("/posts/user/{user_id}")
-async def get_user_posts_route(user_id: int, db: Session = Depends(get_db)):
+async def get_user_posts_route(user_id: int, db: AsyncSession = Depends(get_db)):
     return await get_user_posts(user_id, db)
 
 
-@app.get("/posts/recent_id")
-async def get_recent_post_id_route(db: Session = Depends(get_db)):
-    return await get_recent_post_id(db)
+@app.get("/feed")
+async def get_feed_route(cursor: str = None, limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE),
+                         db: AsyncSession = Depends(get_db)):
+    return await get_feed(cursor, limit, db)
+
+
+@app.get("/feed/user/{user_id}")
+async def get_user_feed_route(user_id: int, cursor: str = None,
+                              limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE),
+                              db: AsyncSession = Depends(get_db)):
+    return await get_user_feed(user_id, cursor, limit, db)
+
+
+@app.get("/feed/pictured/{user_id}")
+async def get_pictured_feed_route(user_id: int, cursor: str = None,
+                                  limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_MAX_PAGE_SIZE),
+                                  db: AsyncSession = Depends(get_db)):
+    return await get_pictured_feed(user_id, cursor, limit, db)
+
+
+@app.get("/leaderboard")
+async def get_leaderboard_route(by: str = "total", cursor: str = None,
+                                limit: int = Query(leaderboard.LEADERBOARD_PAGE_SIZE, ge=1,
+                                                   le=leaderboard.LEADERBOARD_MAX_PAGE_SIZE),
+                                db: AsyncSession = Depends(get_db)):
+    return await leaderboard.get_leaderboard(by, cursor, limit, db)
+
+
+@app.get("/metrics/inference")
+async def get_inference_metrics_route():
+    return inference.get_metrics()
 
 
 @app.post("/refresh_token")
-async def refresh_token_route(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    return await refresh_token(token, db)
+async def refresh_token_route(principal: Principal = Depends(get_principal)):
+    return await refresh_token(principal)
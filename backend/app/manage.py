@@ -0,0 +1,354 @@
+import argparse
+import asyncio
+import os
+import sys
+
+from sqlalchemy import select, text, update
+from sqlalchemy.orm import undefer
+
+from database import Post, SessionLocal, User, migrate
+from plates import plate_index
+from storage import get_blob_store
+
+
+def migrate_images(batch_size: int):
+    """Move inline post images out of Postgres into the blob store, one batch per transaction."""
+    store = get_blob_store()
+    last_id = 0
+    moved = 0
+    while True:
+        with SessionLocal() as db:
+            posts = (db.query(Post)
+                     .options(undefer(Post.image))
+                     .filter(Post.id > last_id, Post.image_key.is_(None), Post.image.isnot(None))
+                     .order_by(Post.id)
+                     .limit(batch_size)
+                     .all())
+            if not posts:
+                break
+            for post in posts:
+                post.image_key = store.put(post.image)
+                post.image_size = len(post.image)
+                post.image = None
+            last_id = posts[-1].id
+            moved += len(posts)
+            db.commit()
+            print(f"moved {moved} images (up to post {last_id})")
+
+
+def recompute_stats():
+    """Rebuild every user's post aggregates from the posts table, e.g. after upgrading or a manual cleanup."""
+    with SessionLocal() as db:
+        result = db.execute(text("""
+            UPDATE users SET
+                post_count = coalesce(posted.post_count, 0),
+                score_sum = coalesce(posted.score_sum, 0),
+                average_score = coalesce(posted.average_score, 0),
+                best_score = posted.best_score,
+                pictured_count = coalesce(pictured.pictured_count, 0)
+            FROM users AS u
+            LEFT JOIN (SELECT user_id, count(score) AS post_count, sum(score) AS score_sum,
+                              avg(score::float8) AS average_score, max(score) AS best_score
+                       FROM posts GROUP BY user_id) AS posted ON posted.user_id = u.id
+            LEFT JOIN (SELECT pictured_user_id, count(*) AS pictured_count
+                       FROM posts GROUP BY pictured_user_id) AS pictured ON pictured.pictured_user_id = u.id
+            WHERE users.id = u.id
+        """))
+        db.commit()
+        print(f"recomputed stats of {result.rowcount} users")
+
+
+def link_plates(batch_size: int):
+    """Link existing posts to the user whose registered plate matches the recognized one, one batch per transaction."""
+    with SessionLocal() as db:
+        plate_index.load(db.execute(select(User.id, User.plate_number).where(User.plate_number.isnot(None))).all())
+    last_id = 0
+    linked = 0
+    while True:
+        with SessionLocal() as db:
+            # only the columns needed, legacy posts still hold their image inline
+            rows = db.execute(select(Post.id, Post.pictured_plate_number)
+                              .where(Post.id > last_id, Post.pictured_user_id.is_(None),
+                                     Post.pictured_plate_number.isnot(None))
+                              .order_by(Post.id)
+                              .limit(batch_size)).all()
+            if not rows:
+                break
+            matches = [{"id": row.id, "pictured_user_id": user_id} for row in rows
+                       if (user_id := plate_index.match(row.pictured_plate_number)) is not None]
+            if matches:
+                # bulk UPDATE by primary key
+                db.execute(update(Post), matches)
+            linked += len(matches)
+            last_id = rows[-1].id
+            db.commit()
+            print(f"linked {linked} posts (up to post {last_id})")
+    # the users' pictured counts include the newly linked posts
+    recompute_stats()
+
+
+def export_detector(imgsz: int, batch: int, int8: bool, output: str | None):
+    from model_registry import YOLO_MODEL_PATH
+    from vehicle_detection_tracker.VehicleDetectionTracker.detectors import export_onnx
+    print(f"wrote {export_onnx(YOLO_MODEL_PATH, output, imgsz, batch, int8)}")
+
+
+def check_detector(image_dir: str, onnx_path: str | None, tolerance: float, min_conf: float) -> bool:
+    """
+    Run the ONNX detector and the ultralytics one over a folder of images and compare their boxes. Every box of
+    either with at least `min_conf` confidence needs a box of the same class from the other whose coordinates are
+    within `tolerance` of the image size. Boxes closer to the confidence threshold may come and go between the
+    backends, so they aren't counted.
+    """
+    import cv2
+    import numpy as np
+    from model_registry import YOLO_MODEL_PATH, YOLO_ONNX_PATH
+    from vehicle_detection_tracker.VehicleDetectionTracker.detectors import load_detector
+
+    reference = load_detector("ultralytics", YOLO_MODEL_PATH)
+    candidate = load_detector("onnx", onnx_path or YOLO_ONNX_PATH)
+    failures = 0
+    for name in sorted(os.listdir(image_dir)):
+        image = cv2.imread(os.path.join(image_dir, name))
+        if image is None:
+            continue
+        expected, actual = reference.detect([image])[0], candidate.detect([image])[0]
+        scale = max(image.shape[:2])
+        unmatched = [j for j in range(len(actual)) if actual.conf[j] >= min_conf]
+        missing = 0
+        worst = 0.0
+        for box, cls, conf in zip(expected.xywh, expected.cls, expected.conf):
+            errors = [(np.abs(actual.xywh[j] - box).max() / scale, j) for j in range(len(actual))
+                      if actual.cls[j] == cls]
+            if not errors or min(errors)[0] > tolerance:
+                missing += conf >= min_conf
+                continue
+            error, j = min(errors)
+            worst = max(worst, error)
+            if j in unmatched:
+                unmatched.remove(j)
+        passed = not missing and not unmatched
+        failures += not passed
+        print(f"{'ok' if passed else 'FAIL'} {name}: {len(expected)} boxes, {missing} missing, {len(unmatched)} extra, "
+              f"max error {worst:.4f}")
+    print(f"{failures} images failed")
+    return failures == 0
+
+
+def convert_classifiers(check_dir: str | None, tolerance: float) -> bool:
+    """
+    Convert the color and make/model classifiers to ONNX for CLASSIFIER_BACKEND=onnx. With `check_dir`, run both
+    backends over the images in it (whole images stand in for vehicle crops) and require the same top 3 classes,
+    in the same order, with probabilities within `tolerance`.
+    """
+    from vehicle_detection_tracker.VehicleDetectionTracker.color_classifier import classifier as color_module
+    from vehicle_detection_tracker.VehicleDetectionTracker.model_classifier import classifier as model_module
+    from vehicle_detection_tracker.VehicleDetectionTracker.runtime import convert_to_onnx
+
+    for module in (color_module, model_module):
+        print(f"wrote {convert_to_onnx(module.model_file, module.input_layer, module.output_layer)}")
+    if check_dir is None:
+        return True
+
+    import cv2
+    failures = 0
+    for module in (color_module, model_module):
+        reference, candidate = module.Classifier("tensorflow"), module.Classifier("onnx")
+        for name in sorted(os.listdir(check_dir)):
+            image = cv2.imread(os.path.join(check_dir, name))
+            if image is None:
+                continue
+            expected, actual = reference.predict(image), candidate.predict(image)
+            same_classes = [{**c, "prob": None} for c in expected] == [{**c, "prob": None} for c in actual]
+            error = max(abs(float(e["prob"]) - float(a["prob"])) for e, a in zip(expected, actual))
+            passed = same_classes and error <= tolerance
+            failures += not passed
+            print(f"{'ok' if passed else 'FAIL'} {module.__name__.split('.')[-2]} {name}: max prob error {error:.5f}")
+    print(f"{failures} checks failed")
+    return failures == 0
+
+
+def check_oauth(port: int) -> bool:
+    """
+    Log in through auth.verify_login against oauth_standin served on `port`. A good code has to yield the stand-in
+    user's claims, and each way the stand-in can misbehave has to be answered with the matching 4xx/5xx instead of a
+    crash. It stops short of auth_google's user lookup, so it needs no database and writes nothing.
+    """
+    import threading
+    import time
+
+    import uvicorn
+    from fastapi import HTTPException
+
+    import auth
+    import oauth_standin
+
+    issuer = f"http://127.0.0.1:{port}"
+    email = "oauth-check@athenian.org"
+    provider = auth.OAuthProvider("standin-client", "standin-secret", f"{issuer}/callback", f"{issuer}/token",
+                                  f"{issuer}/certs", [issuer])
+    app = oauth_standin.create_app(issuer, provider.client_id, email, "OAuth Check")
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    async def run_checks() -> int:
+        failures = 0
+        try:
+            for code, expected in (("valid", 200), ("invalid", 400), ("no-id-token", 502), ("wrong-audience", 400),
+                                   ("bad-at-hash", 400)):
+                try:
+                    claims = await auth.verify_login(code, provider)
+                    status = 200
+                except HTTPException as e:
+                    claims, status = None, e.status_code
+                passed = status == expected and (claims is None or claims["email"] == email)
+                failures += not passed
+                print(f"{'ok' if passed else 'FAIL'} {code}: {status} (expected {expected})")
+        finally:
+            await auth.close_http_client()
+        return failures
+
+    try:
+        failures = asyncio.run(run_checks())
+    finally:
+        server.should_exit = True
+        thread.join()
+    print(f"{failures} checks failed")
+    return failures == 0
+
+
+# modules that must only be loaded with the models, never by importing the application
+HEAVY_MODULES = ("tensorflow", "torch", "ultralytics", "fastanpr", "onnxruntime", "scipy")
+_IMPORT_MAIN = f"""
+import sys, time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))
+"""
+
+
+def bench_startup(runs: int, max_import_seconds: float, serve: bool, port: int, ready_timeout: float) -> bool:
+    """
+    Time `import main` in fresh interpreters and check that it loads none of HEAVY_MODULES. With `serve`, also start
+    uvicorn and time how long /healthz and /readyz take to answer 200.
+    """
+    import statistics
+    import subprocess
+    import time
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    times, heavy = [], set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _IMPORT_MAIN], cwd=app_dir, check=True, capture_output=True,
+                                text=True).stdout.split("\n")
+        times.append(float(output[0]))
+        heavy.update(filter(None, output[1].split(",")))
+    import_seconds = statistics.median(times)
+    passed = import_seconds <= max_import_seconds and not heavy
+    print(f"import main: median {import_seconds:.3f}s over {runs} runs (max {max_import_seconds:.3f}s)")
+    if heavy:
+        print(f"import main loaded {', '.join(sorted(heavy))}")
+    if not serve:
+        return passed
+
+    import httpx
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "--port", str(port), "main:app"], cwd=app_dir)
+    timings = {}
+    try:
+        while len(timings) < 2 and time.perf_counter() - start < ready_timeout and server.poll() is None:
+            for path in ("/healthz", "/readyz"):
+                if path in timings:
+                    continue
+                try:
+                    if httpx.get(f"http://127.0.0.1:{port}{path}", timeout=1).status_code == 200:
+                        timings[path] = time.perf_counter() - start
+                except httpx.HTTPError:
+                    pass
+            time.sleep(0.05)
+    finally:
+        server.terminate()
+        server.wait()
+    for path in ("/healthz", "/readyz"):
+        print(f"{path}: " + (f"{timings[path]:.2f}s" if path in timings else f"not up after {ready_timeout:.0f}s"))
+    return passed and len(timings) == 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="parkit management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("migrate", help="create missing tables and apply the schema upgrades")
+
+    migrate_images_parser = subparsers.add_parser("migrate-images", help="move post images into the blob store")
+    migrate_images_parser.add_argument("--batch-size", type=int, default=100)
+
+    link_plates_parser = subparsers.add_parser("link-plates", help="link posts to the user whose plate is pictured")
+    link_plates_parser.add_argument("--batch-size", type=int, default=500)
+
+    subparsers.add_parser("recompute-stats", help="rebuild the users' score aggregates from their posts")
+
+    export_parser = subparsers.add_parser("export-detector", help="export YOLO to ONNX for DETECTOR_BACKEND=onnx")
+    export_parser.add_argument("--imgsz", type=int, default=640)
+    export_parser.add_argument("--batch", type=int, default=1)
+    export_parser.add_argument("--int8", action="store_true", help="quantize the weights to int8")
+    export_parser.add_argument("--output", default=None)
+
+    check_parser = subparsers.add_parser("check-detector", help="compare the ONNX detector with ultralytics")
+    check_parser.add_argument("image_dir")
+    check_parser.add_argument("--onnx", default=None, help="model to check, YOLO_ONNX_PATH by default")
+    check_parser.add_argument("--tolerance", type=float, default=0.01, help="max box error, relative to image size")
+    check_parser.add_argument("--min-conf", type=float, default=0.5)
+
+    convert_parser = subparsers.add_parser("convert-classifiers",
+                                           help="convert the classifiers to ONNX for CLASSIFIER_BACKEND=onnx")
+    convert_parser.add_argument("--check-dir", default=None, help="compare both backends on the images in it")
+    convert_parser.add_argument("--tolerance", type=float, default=1e-3, help="max top 3 probability difference")
+
+    oauth_parser = subparsers.add_parser("check-oauth", help="log in against a local stand-in OAuth server")
+    oauth_parser.add_argument("--port", type=int, default=5556)
+
+    bench_parser = subparsers.add_parser("bench-startup", help="time application startup")
+    bench_parser.add_argument("--runs", type=int, default=5)
+    bench_parser.add_argument("--max-import-seconds", type=float, default=3.0)
+    bench_parser.add_argument("--serve", action="store_true", help="also time /healthz and /readyz under uvicorn")
+    bench_parser.add_argument("--port", type=int, default=5055)
+    bench_parser.add_argument("--ready-timeout", type=float, default=300.0)
+
+    worker_parser = subparsers.add_parser("worker", help="process queued uploads (INGEST_MODE=async)")
+    worker_parser.add_argument("--batch-size", type=int, default=None)
+    worker_parser.add_argument("--poll-interval", type=float, default=None)
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate()
+    elif args.command == "migrate-images":
+        migrate_images(args.batch_size)
+    elif args.command == "link-plates":
+        link_plates(args.batch_size)
+    elif args.command == "recompute-stats":
+        recompute_stats()
+    elif args.command == "export-detector":
+        export_detector(args.imgsz, args.batch, args.int8, args.output)
+    elif args.command == "check-detector":
+        sys.exit(0 if check_detector(args.image_dir, args.onnx, args.tolerance, args.min_conf) else 1)
+    elif args.command == "convert-classifiers":
+        sys.exit(0 if convert_classifiers(args.check_dir, args.tolerance) else 1)
+    elif args.command == "check-oauth":
+        sys.exit(0 if check_oauth(args.port) else 1)
+    elif args.command == "bench-startup":
+        sys.exit(0 if bench_startup(args.runs, args.max_import_seconds, args.serve, args.port,
+                                    args.ready_timeout) else 1)
+    elif args.command == "worker":
+        # imported here so the other commands don't load the models
+        import worker
+        asyncio.run(worker.run(args.batch_size or worker.WORKER_BATCH_SIZE,
+                               args.poll_interval or worker.WORKER_POLL_INTERVAL))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+
+import numpy as np
+
+from vehicle_detection_tracker.VehicleDetectionTracker.VehicleDetectionTracker import VehicleDetection
+
+YOLO_MODEL_PATH = os.environ.get("YOLO_MODEL_PATH", "yolov8n.pt")
+# "ultralytics" runs YOLO_MODEL_PATH with PyTorch, "onnx" runs YOLO_ONNX_PATH with ONNX Runtime. Create the ONNX
+# model with `manage.py export-detector` and compare it with `manage.py check-detector` before switching
+DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "ultralytics")
+YOLO_ONNX_PATH = os.environ.get("YOLO_ONNX_PATH", "yolov8n.onnx")
+# "tensorflow" runs the frozen color and make/model graphs, "onnx" runs their conversions with ONNX Runtime and
+# never imports TensorFlow. Convert and compare them with `manage.py convert-classifiers` before switching
+CLASSIFIER_BACKEND = os.environ.get("CLASSIFIER_BACKEND", "tensorflow")
+# JPEG quality of the frame a post stores as its full size image, see frames.encode_full
+POST_IMAGE_QUALITY = int(os.environ.get("POST_IMAGE_QUALITY", "95"))
+
+
+class SharedModel:
+    """
+    A model instance shared by every request in the process.
+
+    Use it as a context manager: the model is handed out while holding a lock, since neither the ultralytics
+    predictor nor FastANPR are safe to run from several threads at once.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self.model
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+
+
+_models: dict[str, SharedModel] = {}
+_load_lock = threading.Lock()
+
+
+def _warm_up_anpr(anpr):
+    blank = np.zeros((640, 640, 3), dtype=np.uint8)
+    asyncio.run(anpr.run([blank]))
+
+
+def load_models():
+    """Load every model once and run a warm-up inference through each. Safe to call more than once."""
+    with _load_lock:
+        if _models:
+            return
+        # imported here so that importing the application doesn't load ultralytics and PyTorch
+        from fastanpr import FastANPR
+
+        model_path = YOLO_ONNX_PATH if DETECTOR_BACKEND == "onnx" else YOLO_MODEL_PATH
+        vehicle_detection = VehicleDetection(model_path, image_format="jpeg", image_quality=POST_IMAGE_QUALITY,
+                                             backend=DETECTOR_BACKEND, classifier_backend=CLASSIFIER_BACKEND)
+        vehicle_detection.warm_up()
+
+        anpr = FastANPR()
+        _warm_up_anpr(anpr)
+
+        _models["vehicle_detection"] = SharedModel(vehicle_detection)
+        _models["anpr"] = SharedModel(anpr)
+
+
+def models_loaded() -> bool:
+    return bool(_models)
+
+
+def vehicle_detection() -> SharedModel:
+    load_models()
+    return _models["vehicle_detection"]
+
+
+def anpr() -> SharedModel:
+    load_models()
+    return _models["anpr"]
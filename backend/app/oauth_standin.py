@@ -0,0 +1,91 @@
+"""
+A local stand-in for Google's OAuth endpoints, so the login flow can run without Google. Every authorization code
+is accepted and yields an RS256 id_token (with at_hash) for one configured user, except a few codes that make it
+misbehave the ways a real provider can:
+
+- "invalid": the token endpoint rejects the code
+- "no-id-token": the token response has no id_token
+- "wrong-audience": the id_token is issued to another client
+- "bad-at-hash": the id_token's at_hash doesn't match the access token
+
+Run it with `python oauth_standin.py` and set GOOGLE_AUTH_URL, GOOGLE_TOKEN_URL, GOOGLE_JWKS_URL and
+GOOGLE_ISSUERS to what it prints. `manage.py check-oauth` runs the login flow (auth.verify_login) against it.
+"""
+import argparse
+import os
+import time
+import uuid
+
+import rsa
+from fastapi import FastAPI, Form, HTTPException
+from fastapi.responses import RedirectResponse
+from jose import jwk, jwt
+
+KEY_ID = "standin"
+
+
+def create_app(issuer: str, audience: str, email: str, name: str) -> FastAPI:
+    # a fresh key every start, like a provider that just rotated its keys
+    _, private_key = rsa.newkeys(2048)
+    private_pem = private_key.save_pkcs1().decode()
+    public_jwk = jwk.construct(private_pem, "RS256").public_key().to_dict()
+    public_jwk.update(kid=KEY_ID, use="sig")
+
+    app = FastAPI()
+
+    @app.get("/auth")
+    async def authorize(redirect_uri: str, state: str = None):
+        # no consent screen, the user always agrees
+        query = "code=valid" + (f"&state={state}" if state else "")
+        return RedirectResponse(f"{redirect_uri}?{query}")
+
+    @app.post("/token")
+    async def token(code: str = Form(...), client_id: str = Form(...)):
+        if code == "invalid" or client_id != audience:
+            raise HTTPException(status_code=400, detail="invalid_grant")
+        access_token = uuid.uuid4().hex
+        now = int(time.time())
+        claims = {
+            "iss": issuer,
+            "aud": "another-client" if code == "wrong-audience" else audience,
+            "sub": email,
+            "email": email,
+            "email_verified": True,
+            "hd": email.split("@")[1],
+            "name": name,
+            "iat": now,
+            "exp": now + 3600,
+        }
+        # jose derives at_hash from the access token it is given
+        signed_for = uuid.uuid4().hex if code == "bad-at-hash" else access_token
+        id_token = jwt.encode(claims, private_pem, algorithm="RS256", headers={"kid": KEY_ID},
+                              access_token=signed_for)
+        tokens = {"access_token": access_token, "token_type": "Bearer", "expires_in": 3600}
+        if code != "no-id-token":
+            tokens["id_token"] = id_token
+        return tokens
+
+    @app.get("/certs")
+    async def certs():
+        return {"keys": [public_jwk]}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local stand-in for Google's OAuth endpoints")
+    parser.add_argument("--port", type=int, default=5556)
+    parser.add_argument("--client-id", default=os.environ.get("GOOGLE_CLIENT_ID", "standin-client"))
+    parser.add_argument("--email", default="student@athenian.org")
+    parser.add_argument("--name", default="Stand-in Student")
+    args = parser.parse_args()
+
+    import uvicorn
+    issuer = f"http://127.0.0.1:{args.port}"
+    print(f"GOOGLE_AUTH_URL={issuer}/auth GOOGLE_TOKEN_URL={issuer}/token GOOGLE_JWKS_URL={issuer}/certs "
+          f"GOOGLE_ISSUERS={issuer} GOOGLE_CLIENT_ID={args.client_id}")
+    uvicorn.run(create_app(issuer, args.client_id, args.email, args.name), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,69 @@
+import json
 import math
+import os
 
 import numpy as np
-from scipy.interpolate import interp1d, PchipInterpolator
 
-from vehicle_detection_tracker.VehicleDetectionTracker.VehicleDetectionTracker import VehicleDetection
+import model_registry
+from vehicle_detection_tracker.VehicleDetectionTracker.VehicleDetectionTracker import FIELD_COLOR, FIELD_MODEL
 
+# the crops are never used, so they aren't computed. The stored image is encoded from the full resolution frame
+# (see frames.encode_full) and annotated on read
+DETECTION_FIELDS = {FIELD_COLOR, FIELD_MODEL}
+# how many of the vehicles closest to the stall get color and make/model classification
+CLASSIFY_TOP_K = int(os.environ.get("CLASSIFY_TOP_K", "1"))
 
-# calculates the rating of a single parking job based on how well it is between the lines
-def get_image_info(image: np.ndarray, x_1l: float, x_2l: float):
-    vehicle_detection = VehicleDetection()
-    frame_data = vehicle_detection.process_image(image)
-    # remove "vehicle_frame_base64" from frame_data["detected_vehicles"]
-    for vehicle in frame_data["detected_vehicles"]:
-        vehicle.pop("vehicle_frame_base64", None)
+
+# items are (BGR image, (x_1l, x_2l)) pairs
+def detect_vehicles(items: list[tuple[np.ndarray, tuple[float, float]]]) -> list[dict]:
+    images = [image for image, _ in items]
+    stalls = [stall for _, stall in items]
+    with model_registry.vehicle_detection() as vehicle_detection:
+        return vehicle_detection.process_images(images, DETECTION_FIELDS, stalls, CLASSIFY_TOP_K)
+
+
+# the detected vehicle closest to the center of the parking spot, the one that gets rated
+def parked_vehicle(frame_data: dict, x_1l: float, x_2l: float) -> dict | None:
+    vehicles = frame_data["detected_vehicles"]
+    if not vehicles:
+        return None
+    x_m = x_1l + (x_2l - x_1l) / 2
+    return min(vehicles, key=lambda vehicle: abs(vehicle["vehicle_coordinates"]["x"] - x_m))
+
+
+# the detections of a process_image response as the arrays stored in PostDetections
+def detection_arrays(frame_data: dict, width: int, height: int, rated: dict | None) -> dict:
+    vehicles = frame_data["detected_vehicles"]
+    boxes = []
+    for vehicle in vehicles:
+        coords = vehicle["vehicle_coordinates"]
+        boxes += [coords["x"] / width, coords["y"] / height, coords["width"] / width, coords["height"] / height]
+    colors, makes = [], []
+    for vehicle in vehicles:
+        color_info, model_info = vehicle.get("color_info"), vehicle.get("model_info")
+        colors.append(json.loads(color_info)[0]["color"] if color_info else None)
+        if model_info:
+            make = json.loads(model_info)[0]
+            makes.append(f"{make['make']} {make['model']}")
+        else:
+            makes.append(None)
+    return {
+        "labels": [vehicle["vehicle_type"] for vehicle in vehicles],
+        "confidences": [vehicle["detection_confidence"] for vehicle in vehicles],
+        "boxes": boxes,
+        "colors": colors,
+        "makes": makes,
+        "rated": vehicles.index(rated) if rated is not None else None,
+    }
+
+
+# rates a parking job from the output of VehicleDetection.process_image
+def rate_frame(frame_data: dict, x_1l: float, x_2l: float):
     print(frame_data["detected_vehicles"])
     if frame_data["number_of_vehicles_detected"] < 1:
         return -1
 
-    # filter by closeness to the center of the parking spot
-    vehicles = frame_data["detected_vehicles"]
-    vehicles.sort(key=lambda vehicle: abs(vehicle["vehicle_coordinates"]["x"] - (x_1l + (x_2l - x_1l) / 2)))
-
-    vehicle = vehicles[0]
+    vehicle = parked_vehicle(frame_data, x_1l, x_2l)
     print(vehicle)
     coords = vehicle["vehicle_coordinates"]
     x_c = coords["x"]
@@ -34,7 +76,8 @@ def get_image_info(image: np.ndarray, x_1l: float, x_2l: float):
     x_points = [0, 8, 9.81, 10]
     y_points = [0, 4.14, 9.81, 10]
 
-    # Create the PCHIP interpolator
+    # Create the PCHIP interpolator, scipy is imported here to keep it out of application startup
+    from scipy.interpolate import PchipInterpolator
     interpolator = PchipInterpolator(x_points, y_points)
     score: float = interpolator(score).item()
 
@@ -43,8 +86,6 @@ def get_image_info(image: np.ndarray, x_1l: float, x_2l: float):
     print(f"x_c: {x_c}")
     print(f"error: {error}")
 
-    # create dict with score and annotated image
     return {
         "score": score,
-        "annotated_image_base64": frame_data["annotated_image_base64"]
     }
\ No newline at end of file
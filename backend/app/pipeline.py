@@ -0,0 +1,52 @@
+import asyncio
+import os
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+import inference
+from batching import MicroBatcher
+from frames import decode_frame, encode_full
+from model_registry import POST_IMAGE_QUALITY
+from parking_rating import detect_vehicles, rate_frame, parked_vehicle, detection_arrays
+from utils import detect_plates, closest_plate, get_bars_x
+
+# fraction of the vehicle's size added on every side of the crop ANPR reads the plate from
+PLATE_ROI_PADDING = float(os.environ.get("PLATE_ROI_PADDING", "0.15"))
+
+# images from concurrent uploads are collected into one forward pass per model
+plate_batcher = MicroBatcher(detect_plates)
+vehicle_batcher = MicroBatcher(detect_vehicles)
+
+
+async def analyze_image(contents: bytes):
+    frame = await inference.run(decode_frame, contents)
+    # stall lines and vehicles are in the coordinates of the small frame
+    x_1l, x_2l = get_bars_x(frame.small)
+
+    # the stored image is encoded from the full frame, not the one the models saw, so it keeps its resolution.
+    # OpenCV releases the GIL while encoding, so this overlaps with detection without shipping the frame to a pool
+    frame_data, image = await asyncio.gather(vehicle_batcher.submit((frame.small, (x_1l, x_2l))),
+                                             run_in_threadpool(encode_full, frame, POST_IMAGE_QUALITY))
+
+    vehicle = parked_vehicle(frame_data, x_1l, x_2l)
+    if vehicle is None:
+        raise HTTPException(status_code=422, detail="No vehicle found in the image")
+
+    # read the plate of the rated vehicle only, so plate and score always refer to the same car
+    plate_number = None
+    coords = vehicle["vehicle_coordinates"]
+    roi = frame.rgb_roi(coords["x"], coords["y"], coords["width"], coords["height"], PLATE_ROI_PADDING)
+    if roi.size:
+        plates = await plate_batcher.submit(roi)
+        # the crop is centered on the vehicle, so its plate is the one closest to the middle
+        plate_number = closest_plate(plates, 0, roi.shape[1])
+
+    rating = rate_frame(frame_data, x_1l, x_2l)
+    height, width = frame.small.shape[:2]
+    image_info = {
+        "score": rating["score"],
+        "image": image,
+        "detections": detection_arrays(frame_data, width, height, vehicle),
+    }
+    return plate_number, image_info
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bktree import BKTree
+from database import User
+
+PLATE_MAX_DISTANCE = int(os.environ.get("PLATE_MAX_DISTANCE", "1"))  # edits allowed after normalizing
+PLATE_MIN_LENGTH = int(os.environ.get("PLATE_MIN_LENGTH", "4"))  # shorter registered plates are placeholders
+# other replicas' plate changes are picked up by reloading the index this often
+PLATE_INDEX_TTL = int(os.environ.get("PLATE_INDEX_TTL", "60"))  # seconds
+
+# characters OCR mixes up, mapped to one representative so they compare equal
+CONFUSABLE = str.maketrans({
+    "O": "0", "Q": "0", "D": "0",
+    "I": "1", "L": "1",
+    "Z": "2",
+    "S": "5",
+    "G": "6",
+    "B": "8",
+})
+
+
+def normalize_plate(plate: str | None) -> str:
+    """Uppercase alphanumerics of a plate with confusable characters folded together, e.g. "8OB-1l2" -> "808112"."""
+    if not plate:
+        return ""
+    return "".join(c for c in plate.upper() if c.isalnum()).translate(CONFUSABLE)
+
+
+def levenshtein(a: str, b: str) -> int:
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class PlateIndex:
+    """
+    Registered plates of all users, for linking OCR results to the user in the picture.
+
+    Plates are compared by their normalized key, exactly through a dict and within PLATE_MAX_DISTANCE edits through
+    a BK-tree under Levenshtein distance. A plate is only resolved when a single user is the closest match.
+    """
+
+    def __init__(self):
+        self._users: dict[str, set[int]] = {}  # normalized plate -> user ids
+        self._keys: dict[int, str] = {}  # user id -> normalized plate
+        self._tree = BKTree(levenshtein)
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    def load(self, rows):
+        """Replace the index with (user id, plate number) rows."""
+        users, keys, tree = {}, {}, BKTree(levenshtein)
+        for user_id, plate in rows:
+            key = normalize_plate(plate)
+            if len(key) < PLATE_MIN_LENGTH:
+                continue
+            if key not in users:
+                users[key] = set()
+                tree.add(key, key)
+            users[key].add(user_id)
+            keys[user_id] = key
+        self._users, self._keys, self._tree = users, keys, tree
+        self._loaded_at = time.monotonic()
+
+    async def refresh(self, db: AsyncSession):
+        async with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at <= PLATE_INDEX_TTL:
+                return
+            self.load((await db.execute(select(User.id, User.plate_number)
+                                        .where(User.plate_number.isnot(None)))).all())
+
+    def update(self, user_id: int, plate: str | None):
+        """Apply a user's plate change without waiting for the next reload."""
+        old_key = self._keys.pop(user_id, None)
+        if old_key is not None:
+            self._users[old_key].discard(user_id)
+        key = normalize_plate(plate)
+        if len(key) < PLATE_MIN_LENGTH:
+            return
+        if key not in self._users:
+            self._users[key] = set()
+            self._tree.add(key, key)
+        self._users[key].add(user_id)
+        self._keys[user_id] = key
+
+    def match(self, plate: str | None) -> int | None:
+        key = normalize_plate(plate)
+        if len(key) < PLATE_MIN_LENGTH:
+            return None
+        users = self._users.get(key)
+        if not users:
+            # keys stay in the tree after their last user changed plates
+            matches = [match for match in self._tree.search(key, PLATE_MAX_DISTANCE) if self._users[match[1]]]
+            if not matches:
+                return None
+            best = matches[0][0]
+            users = set().union(*(self._users[match_key] for d, match_key, _ in matches if d == best))
+        # an ambiguous plate is better left unlinked than linked to the wrong user
+        return next(iter(users)) if len(users) == 1 else None
+
+    async def resolve(self, db: AsyncSession, plate: str | None) -> int | None:
+        """Id of the user whose registered plate best matches an OCR result, if exactly one does."""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > PLATE_INDEX_TTL:
+            await self.refresh(db)
+        return self.match(plate)
+
+
+plate_index = PlateIndex()
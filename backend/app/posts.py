@@ -1,91 +1,339 @@
 import base64
+import binascii
+import os
+from datetime import datetime
+
 from fastapi import HTTPException, UploadFile, File, Form, Depends
-from sqlalchemy.orm import Session
-from jose import jwt
+from fastapi.responses import FileResponse, JSONResponse, Response
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, load_only, selectinload
+from starlette.concurrency import run_in_threadpool
+
+import inference
+import leaderboard
+from database import IngestJob, Post, PostDetections, PostImage, User
+from dedup import DEDUP_ENABLED, compute_hashes, duplicate_index
+from derivatives import (make_derivatives, IMAGE_SIZES, IMAGE_FORMATS, IMAGE_QUALITY, DEFAULT_SIZE, DEFAULT_FORMAT,
+                         MEDIA_TYPES)
+from model_registry import POST_IMAGE_QUALITY
+from storage import get_blob_store
+from pipeline import analyze_image
+from plates import plate_index
+from render import render_annotated, render_cache
+from auth import Principal, get_principal
 
-from backend.app.parking_rating import get_image_info
-from database import Post, User
-from utils import get_plate_number, bytes_to_ndarray, get_bars_x
-from auth import oauth2_scheme, GOOGLE_CLIENT_SECRET
+# "sync" analyzes uploads inside the request, "async" queues them for the ingest worker and answers 202
+INGEST_MODE = os.environ.get("INGEST_MODE", "sync")
+FEED_PAGE_SIZE = int(os.environ.get("FEED_PAGE_SIZE", "20"))
+FEED_MAX_PAGE_SIZE = int(os.environ.get("FEED_MAX_PAGE_SIZE", "100"))
 
 
 async def create_post(file: UploadFile = File(...),
-                      db: Session = Depends(), token: str = Depends(oauth2_scheme)):
+                      db: AsyncSession = Depends(), principal: Principal = Depends(get_principal)):
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File is not an image")
     if file.size > 20 * 1024 * 1024:
         raise HTTPException(status_code=400, detail="File is too large")
 
-    payload = jwt.decode(token, GOOGLE_CLIENT_SECRET, algorithms=["HS256"])
-    user_email = payload["email"]
-
-    user = db.query(User).filter(User.email == user_email).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    # end the read transaction, if resolving the principal opened one, so no pooled connection is held while the
+    # upload is analyzed
+    await db.commit()
 
     contents = await file.read()
-    image = bytes_to_ndarray(contents)
-    x_1l, x_2l = get_bars_x(image)
+    if INGEST_MODE == "async":
+        return await enqueue_upload(db, principal.id, contents)
+
+    async with inference.admission():
+        return await process_upload(db, principal.id, contents)
 
-    plate_number = await get_plate_number(image, x_1l, x_2l)
 
-    # get score and annotated image
-    image_info = get_image_info(image, x_1l, x_2l)
+async def process_upload(db: AsyncSession, user_id: int, contents: bytes) -> dict:
+    """Analyze an uploaded image and store the resulting post. Used by create_post and by the ingest worker."""
+    hashes = None
+    if DEDUP_ENABLED:
+        hashes = await run_in_threadpool(compute_hashes, contents)
+        duplicate_of = await duplicate_index.find(db, *hashes)
+        if duplicate_of is not None:
+            return await save_post(db, await copy_post(db, duplicate_of, user_id), hashes)
+        # don't hold a pooled connection while the upload is analyzed
+        await db.commit()
+
+    plate_number, image_info = await analyze_image(contents)
     score = image_info["score"]
-    image_base64 = image_info["annotated_image_base64"]
+    image_bytes = image_info["image"]
+    image_key = await run_in_threadpool(get_blob_store().put, image_bytes)
+
+    # thumbnails and re-encoded variants are made once here instead of on every read
+    derivatives = await run_in_threadpool(make_derivatives, image_bytes)
+    post_images = []
+    for size, image_format, data, width, height in derivatives:
+        key = await run_in_threadpool(get_blob_store().put, data)
+        post_images.append(PostImage(size=size, format=image_format, image_key=key, image_size=len(data),
+                                     width=width, height=height))
+
+    post = Post(image_key=image_key, image_size=len(image_bytes), user_id=user_id, pictured_plate_number=plate_number,
+                score=score, images=post_images, detections=PostDetections(**image_info["detections"]))
+    return await save_post(db, post, hashes)
 
-    image_bytes = base64.b64decode(image_base64)
 
-    post = Post(image=image_bytes, user=user, pictured_plate_number=plate_number, score=score)
+async def save_post(db: AsyncSession, post: Post, hashes: tuple[str, int] | None) -> dict:
+    """Insert a new post together with everything derived from it, in one transaction."""
+    post.pictured_user_id = await plate_index.resolve(db, post.pictured_plate_number)
     db.add(post)
-    db.commit()
-    db.refresh(post)
+    if hashes is not None:
+        await db.flush()
+        duplicate_index.record(db, post.id, *hashes)
+    await leaderboard.record_post(db, post)
+    await db.commit()
+    leaderboard.invalidate()
+
+    return {"id": post.id, "plate_number": post.pictured_plate_number, "score": post.score,
+            "pictured_user_id": post.pictured_user_id}
+
+
+async def copy_post(db: AsyncSession, post_id: int, user_id: int) -> Post:
+    """
+    A new post for `user_id` with the analysis results and images of an earlier post. Blobs are content
+    addressed, so the copy points at the same files.
+    """
+    original = await db.scalar(
+        select(Post)
+        .options(load_only(Post.image_key, Post.image_size, Post.pictured_plate_number, Post.score),
+                 selectinload(Post.images), selectinload(Post.detections))
+        .where(Post.id == post_id)
+    )
+    detections = None
+    if original.detections is not None:
+        detections = PostDetections(**{column: getattr(original.detections, column) for column in DETECTION_COLUMNS})
+    return Post(image_key=original.image_key, image_size=original.image_size, user_id=user_id,
+                pictured_plate_number=original.pictured_plate_number, score=original.score,
+                images=[PostImage(size=image.size, format=image.format, image_key=image.image_key,
+                                  image_size=image.image_size, width=image.width, height=image.height)
+                        for image in original.images],
+                detections=detections)
+
+
+DETECTION_COLUMNS = ("labels", "confidences", "boxes", "colors", "makes", "rated")
+
 
-    return {"id": post.id, "plate_number": plate_number, "score": score}
+async def enqueue_upload(db: AsyncSession, user_id: int, contents: bytes) -> JSONResponse:
+    """Store the upload and queue it for the ingest worker, answering right away with the job id."""
+    # not content-addressed, so the worker can delete it when the job is done even if the same image is uploaded again
+    upload_key = await run_in_threadpool(get_blob_store().put_unique, contents)
+    job = IngestJob(user_id=user_id, upload_key=upload_key, status="queued")
+    db.add(job)
+    await db.commit()
+    return JSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+
+
+async def get_ingest_job(job_id: int, db: AsyncSession = Depends(), principal: Principal = Depends(get_principal)):
+    job = await db.get(IngestJob, job_id)
+    if not job or job.user_id != principal.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {
+        "id": job.id,
+        "status": job.status,
+        "postId": job.post_id,
+        "score": job.score,
+        "plateNumber": job.plate_number,
+        "error": job.error,
+    }
+
+
+async def query_post(db: AsyncSession, post_id: int, *columns) -> Post | None:
+    """Load a post with only the given columns, leaving everything else (most importantly the image) unloaded."""
+    return await db.scalar(select(Post).options(load_only(*columns)).where(Post.id == post_id))
+
+
+async def query_post_with_users(db: AsyncSession, post_id: int, *columns) -> Post | None:
+    """Like query_post, also loading the author and the pictured user in the same query."""
+    user_columns = (User.id, User.name, User.email)
+    return await db.scalar(select(Post)
+                           .options(load_only(*columns),
+                                    joinedload(Post.user).load_only(*user_columns),
+                                    joinedload(Post.pictured_user).load_only(*user_columns))
+                           .where(Post.id == post_id))
+
+
+def user_summary(user: User | None) -> dict | None:
+    if user is None:
+        return None
+    return {
+        "id": user.id,
+        "name": user.name,
+        "email": user.email,
+    }
 
 
-async def get_post(post_id: int, db: Session = Depends()):
-    post = db.query(Post).filter(Post.id == post_id).first()
+async def get_image_variant(db: AsyncSession, post: Post, size: str, image_format: str) -> tuple[str | None, str]:
+    """
+    Blob key and media type of a post's image at the given size and format. Posts created before variants
+    existed only have the full size JPEG, which is returned instead.
+    """
+    if size not in IMAGE_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size, expected one of: {', '.join(IMAGE_SIZES)}")
+    if image_format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format, expected one of: {', '.join(IMAGE_FORMATS)}")
+
+    if (size, image_format) != (DEFAULT_SIZE, DEFAULT_FORMAT):
+        variant_key = await db.scalar(select(PostImage.image_key).where(PostImage.post_id == post.id,
+                                                                        PostImage.size == size,
+                                                                        PostImage.format == image_format))
+        if variant_key:
+            return variant_key, MEDIA_TYPES[image_format]
+    return post.image_key, MEDIA_TYPES[DEFAULT_FORMAT]
+
+
+async def load_post_image(db: AsyncSession, post: Post, image_key: str | None) -> bytes:
+    if image_key is None:
+        # not migrated to the blob store yet, load the deferred image column
+        return await db.scalar(select(Post.image).where(Post.id == post.id))
+    return await run_in_threadpool(get_blob_store().get, image_key)
+
+
+async def render_post_image(db: AsyncSession, post: Post, size: str, image_format: str) -> tuple[bytes, str] | None:
+    """
+    A post's image with its detections drawn on, rendered from the stored photo and cached. None for posts from
+    before detections were stored, whose stored image is already annotated.
+    """
+    cache_key = (post.id, size, image_format)
+    rendered = render_cache.get(cache_key)
+    if rendered is not None:
+        return rendered
+    if render_cache.is_missing(post.id):
+        return None
+
+    detections = await db.get(PostDetections, post.id)
+    if detections is None:
+        render_cache.put_missing(post.id)
+        return None
+    image_key, media_type = await get_image_variant(db, post, size, image_format)
+    image = await load_post_image(db, post, image_key)
+    # re-encode at the quality the image was stored at: the full size JPEG is the analyzed frame itself
+    quality = POST_IMAGE_QUALITY if image_key == post.image_key else IMAGE_QUALITY
+    data = await run_in_threadpool(render_annotated, image, detections, media_type, quality)
+    render_cache.put(cache_key, data, media_type)
+    return data, media_type
+
+
+async def get_post(post_id: int, size: str = DEFAULT_SIZE, image_format: str = DEFAULT_FORMAT,
+                   annotated: bool = True, db: AsyncSession = Depends()):
+    post = await query_post(db, post_id, Post.id, Post.image_key)
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
-    return post.image
+
+    if annotated:
+        # rendered images are served from memory (the render cache), only unannotated ones can use sendfile
+        rendered = await render_post_image(db, post, size, image_format)
+        if rendered is not None:
+            return Response(content=rendered[0], media_type=rendered[1])
+
+    image_key, media_type = await get_image_variant(db, post, size, image_format)
+    if image_key is not None:
+        path = get_blob_store().local_path(image_key)
+        if path is not None:
+            # served straight from disk, with sendfile when the server supports it
+            return FileResponse(path, media_type=media_type)
+    return Response(content=await load_post_image(db, post, image_key), media_type=media_type)
 
 
-async def get_post_info(post_id: int, db: Session = Depends()):
-    post = db.query(Post).filter(Post.id == post_id).first()
+async def get_post_info(post_id: int, size: str = DEFAULT_SIZE, image_format: str = DEFAULT_FORMAT,
+                        include_image: bool = True, db: AsyncSession = Depends()):
+    post = await query_post_with_users(db, post_id, Post.id, Post.image_key, Post.score, Post.pictured_plate_number)
 
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
 
-    # Convert the image to base64 encoded string
-    base64_image = base64.b64encode(post.image).decode('utf-8')
+    # clients that fetch the image from imageUrl skip reading it and the base64 copy
+    base64_image = None
+    rendered = await render_post_image(db, post, size, image_format) if include_image else None
+    if rendered is not None:
+        image, media_type = rendered
+    else:
+        image_key, media_type = await get_image_variant(db, post, size, image_format)
+        image = await load_post_image(db, post, image_key) if include_image else None
+    if image is not None:
+        base64_image = base64.b64encode(image).decode('utf-8')
 
     return {
         "image": base64_image,
-        "user": {
-            "id": post.user.id,
-            "name": post.user.name,
-            "email": post.user.email,
-        },
+        "imageType": media_type,
+        "imageUrl": f"/posts/{post.id}?size={size}&format={image_format}",
+        "user": user_summary(post.user),
         "score": post.score,
-        "picturedUser": {
-            "id": post.pictured_user.id,
-            "name": post.pictured_user.name,
-            "email": post.pictured_user.email,
-        },
+        "picturedUser": user_summary(post.pictured_user),
         "picturedPlateNumber": post.pictured_plate_number,
     }
 
 
-async def get_user_posts(user_id: int, db: Session = Depends()):
-    posts = db.query(Post).join(User).filter(User.id == user_id).all()
+async def get_user_posts(user_id: int, db: AsyncSession = Depends()):
+    posts = (await db.execute(select(Post.id).where(Post.user_id == user_id))).all()
     if not posts:
         raise HTTPException(status_code=404, detail="No posts found for the user")
     return [{"id": post.id} for post in posts]
 
 
-async def get_recent_post_id(db: Session = Depends()):
-    post = db.query(Post).order_by(Post.id.desc()).first()
+async def get_recent_post_id(db: AsyncSession = Depends()):
+    post = (await db.execute(select(Post.id).order_by(Post.id.desc()).limit(1))).first()
     if not post:
         raise HTTPException(status_code=404, detail="No posts found")
     return {"id": post.id}
+
+
+def encode_feed_cursor(created_at: datetime, post_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{post_id}".encode()).decode()
+
+
+def decode_feed_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, post_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def get_feed_page(db: AsyncSession, cursor: str | None, limit: int, *filters):
+    """
+    One page of posts matching `filters`, newest first. Pages are keyed on (created_at, id), so every page is
+    a single range scan over one of the posts feed indexes no matter how deep the client has scrolled.
+    """
+    limit = max(1, min(limit, FEED_MAX_PAGE_SIZE))
+    query = select(Post.id, Post.created_at, Post.user_id, Post.pictured_user_id, Post.score).where(*filters)
+    if cursor is not None:
+        query = query.where(tuple_(Post.created_at, Post.id) < decode_feed_cursor(cursor))
+    # fetch one extra row to know whether there is a next page
+    rows = (await db.execute(query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit + 1))).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_feed_cursor(rows[-1].created_at, rows[-1].id)
+    return {
+        "posts": [
+            {
+                "id": row.id,
+                "createdAt": row.created_at.isoformat(),
+                "userId": row.user_id,
+                "picturedUserId": row.pictured_user_id,
+                "score": row.score,
+            }
+            for row in rows
+        ],
+        "nextCursor": next_cursor,
+    }
+
+
+async def get_feed(cursor: str = None, limit: int = FEED_PAGE_SIZE, db: AsyncSession = Depends()):
+    return await get_feed_page(db, cursor, limit)
+
+
+async def get_user_feed(user_id: int, cursor: str = None, limit: int = FEED_PAGE_SIZE,
+                        db: AsyncSession = Depends()):
+    return await get_feed_page(db, cursor, limit, Post.user_id == user_id)
+
+
+async def get_pictured_feed(user_id: int, cursor: str = None, limit: int = FEED_PAGE_SIZE,
+                            db: AsyncSession = Depends()):
+    return await get_feed_page(db, cursor, limit, Post.pictured_user_id == user_id)
@@ -0,0 +1,79 @@
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from database import PostDetections
+from vehicle_detection_tracker.VehicleDetectionTracker.annotation import draw_detections
+
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", str(64 * 1024 * 1024)))
+RENDER_CACHE_MISSING = int(os.environ.get("RENDER_CACHE_MISSING", "10000"))  # posts remembered to have no detections
+
+_ENCODERS = {
+    "image/jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "image/webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def render_annotated(image_bytes: bytes, detections: PostDetections, media_type: str, quality: int) -> bytes:
+    """
+    Draw a post's detections onto one of its stored images, in the same format as the image. Rendering is a second
+    lossy encode, so `quality` should be the one the stored image was encoded at to keep the loss small.
+    """
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    height, width = image.shape[:2]
+    # boxes are stored relative to the image size, so they fit every size variant
+    relative = detections.boxes
+    boxes = [(relative[i] * width, relative[i + 1] * height, relative[i + 2] * width, relative[i + 3] * height)
+             for i in range(0, len(relative), 4)]
+    draw_detections(image, boxes, detections.labels, detections.confidences, highlight=detections.rated)
+    extension, quality_param = _ENCODERS[media_type]
+    _, buffer = cv2.imencode(extension, image, [quality_param, quality])
+    return buffer.tobytes()
+
+
+class RenderCache:
+    """Rendered images by (post id, size, format), least recently used first, bounded by their total size."""
+
+    def __init__(self, max_bytes: int, max_missing: int):
+        self.max_bytes = max_bytes
+        self.max_missing = max_missing
+        self._entries: OrderedDict[tuple, tuple[bytes, str]] = OrderedDict()
+        self._bytes = 0
+        # ids of posts without stored detections. Detections are only written with the post, so this never goes stale
+        self._missing: OrderedDict[int, None] = OrderedDict()
+
+    def get(self, key: tuple) -> tuple[bytes, str] | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, data: bytes, media_type: str):
+        if len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[0])
+        self._entries[key] = (data, media_type)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+
+    def is_missing(self, post_id: int) -> bool:
+        if post_id not in self._missing:
+            return False
+        self._missing.move_to_end(post_id)
+        return True
+
+    def put_missing(self, post_id: int):
+        self._missing[post_id] = None
+        self._missing.move_to_end(post_id)
+        if len(self._missing) > self.max_missing:
+            self._missing.popitem(last=False)
+
+
+render_cache = RenderCache(RENDER_CACHE_BYTES, RENDER_CACHE_MISSING)
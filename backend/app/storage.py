@@ -0,0 +1,104 @@
+import hashlib
+import os
+import tempfile
+import uuid
+from abc import ABC, abstractmethod
+
+BLOB_STORE_BACKEND = os.environ.get("BLOB_STORE_BACKEND", "local")
+BLOB_STORE_PATH = os.environ.get("BLOB_STORE_PATH", "/data/blobs")
+
+
+def blob_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore(ABC):
+    """
+    Blob storage. Blobs stored with `put` are content-addressed: their key is the hex SHA-256 of their content, so
+    identical blobs share one copy. Blobs stored with `put_unique` get a key of their own, so they can be deleted
+    without checking whether anything else refers to the same content.
+    """
+
+    @abstractmethod
+    def put(self, data: bytes) -> str:
+        ...
+
+    @abstractmethod
+    def put_unique(self, data: bytes) -> str:
+        ...
+
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def local_path(self, key: str) -> str | None:
+        """Path of the blob on the local filesystem, if the backend has one, so it can be served with sendfile."""
+        return None
+
+
+class LocalBlobStore(BlobStore):
+    """Stores blobs as files sharded into two levels of directories by key prefix, e.g. ab/cd/abcd..."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put(self, data: bytes) -> str:
+        key = blob_key(data)
+        if not os.path.exists(self._path(key)):
+            self._write(key, data)
+        return key
+
+    def put_unique(self, data: bytes) -> str:
+        key = uuid.uuid4().hex
+        self._write(key, data)
+        return key
+
+    def _write(self, key: str, data: bytes):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file and rename it, so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def delete(self, key: str):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key: str) -> str | None:
+        return self._path(key)
+
+
+BACKENDS = {
+    "local": lambda: LocalBlobStore(BLOB_STORE_PATH),
+}
+
+_blob_store: BlobStore | None = None
+
+
+def get_blob_store() -> BlobStore:
+    global _blob_store
+    if _blob_store is None:
+        if BLOB_STORE_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown blob store backend: {BLOB_STORE_BACKEND}")
+        _blob_store = BACKENDS[BLOB_STORE_BACKEND]()
+    return _blob_store
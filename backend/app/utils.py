@@ -1,25 +1,30 @@
+import asyncio
+
 import numpy as np
-from PIL import Image
-import io
-from typing import List
-from fastanpr import FastANPR, NumberPlate
+from typing import List, TYPE_CHECKING
 
+# fastanpr pulls in ultralytics and PyTorch, which model_registry only loads with the models
+if TYPE_CHECKING:
+    from fastanpr import NumberPlate
 
-async def get_plate_number(image: np.ndarray, x_1l: float, x_2l: float) -> str:
-    image_list = [image]
-    plates: List[List[NumberPlate]] = await FastANPR().run(image_list)
+import model_registry
 
-    x_m = x_1l + (x_2l - x_1l) / 2
-    # sort plates by how close they are to the center of the parking spot
-    plates[0].sort(key=lambda plate: abs((plate.det_box[0] + plate.det_box[2]) / 2 - x_m))
 
-    return plates[0][0].rec_text
+# images are RGB
+def detect_plates(images: List[np.ndarray]) -> List[List["NumberPlate"]]:
+    with model_registry.anpr() as anpr:
+        # FastANPR.run is a coroutine but never actually awaits anything, so drive it to completion here
+        return asyncio.run(anpr.run(images))
 
 
-def bytes_to_ndarray(image_data: bytes) -> np.ndarray:
-    image = Image.open(io.BytesIO(image_data))
-    image_array = np.array(image, dtype=np.uint8)
-    return image_array
+def closest_plate(plates: List["NumberPlate"], x_1l: float, x_2l: float) -> str | None:
+    if not plates:
+        return None
+
+    x_m = x_1l + (x_2l - x_1l) / 2
+    # pick the plate closest to the center of the parking spot
+    plate = min(plates, key=lambda plate: abs((plate.det_box[0] + plate.det_box[2]) / 2 - x_m))
+    return plate.rec_text
 
 
 # def get_bars_x(image: np.ndarray) -> (float, float):
@@ -1,45 +1,108 @@
 import json
 import cv2
 import base64
-from ultralytics import YOLO
 import numpy as np
-from ultralytics.utils.plotting import colors
-from .color_classifier.classifier import Classifier as ColorClassifier
-from .model_classifier.classifier import Classifier as ModelClassifier
+from .annotation import draw_detections
+from .combined_classifier import load_classifier
+from .detectors import load_detector
+
+# Optional artifacts process_image can compute for each image
+FIELD_CROPS = "crops"  # encoded crop of every detected vehicle
+FIELD_ORIGINAL = "original"  # encoded copy of the input image
+FIELD_ANNOTATED = "annotated"  # encoded image with the detections drawn on it
+FIELD_COLOR = "color"  # color classification of every detected vehicle
+FIELD_MODEL = "model"  # make/model classification of every detected vehicle
+ALL_FIELDS = frozenset({FIELD_CROPS, FIELD_ORIGINAL, FIELD_ANNOTATED, FIELD_COLOR, FIELD_MODEL})
+
+# Encoder flags for each supported output format, given the quality
+_ENCODE_PARAMS = {
+    "jpeg": (".jpg", lambda quality: [cv2.IMWRITE_JPEG_QUALITY, quality]),
+    "webp": (".webp", lambda quality: [cv2.IMWRITE_WEBP_QUALITY, quality]),
+    "png": (".png", lambda quality: []),
+}
+
+
+def response_to_base64(response):
+    """
+    Convert the encoded images in a process_image response to base64 strings, for callers that need JSON.
+
+    Args:
+        response (dict): Output of process_image. It is not modified.
+
+    Returns:
+        dict: The same response with "annotated_image", "original_image" and each vehicle's "vehicle_frame"
+        replaced by "annotated_image_base64", "original_image_base64" and "vehicle_frame_base64".
+    """
+    def encode(data):
+        return base64.b64encode(data).decode() if data is not None else None
+
+    converted = {key: value for key, value in response.items() if key not in ("annotated_image", "original_image")}
+    converted["annotated_image_base64"] = encode(response["annotated_image"])
+    converted["original_image_base64"] = encode(response["original_image"])
+    converted["detected_vehicles"] = []
+    for vehicle in response["detected_vehicles"]:
+        vehicle = dict(vehicle)
+        if "vehicle_frame" in vehicle:
+            vehicle["vehicle_frame_base64"] = encode(vehicle.pop("vehicle_frame"))
+        converted["detected_vehicles"].append(vehicle)
+    return converted
+
 
 class VehicleDetection:
 
-    def __init__(self, model_path="yolov8n.pt"):
+    def __init__(self, model_path="yolov8n.pt", image_format="jpeg", image_quality=95, backend="ultralytics",
+                 classifier_backend="tensorflow"):
         """
         Initialize the VehicleDetection class.
 
         Args:
-            model_path (str): Path to the YOLO model file.
+            model_path (str): Path to the YOLO model file, in the format of the backend.
+            backend (str): Detector backend, "ultralytics" (PyTorch) or "onnx" (ONNX Runtime), see detectors.py.
+            classifier_backend (str): Color and make/model classifier runtime, "tensorflow" or "onnx" (ONNX Runtime,
+                TensorFlow is never imported), see runtime.py.
+            image_format (str): Format of the images in the response, "jpeg", "webp" or "png".
+            image_quality (int): Encoder quality from 0 to 100 for "jpeg" and "webp".
         """
+        if image_format not in _ENCODE_PARAMS:
+            raise ValueError(f"Unknown image format: {image_format}")
+        extension, params = _ENCODE_PARAMS[image_format]
+        self._encode_extension = extension
+        self._encode_params = params(image_quality)
         # Load the YOLO model
-        self.model = YOLO(model_path)
-        self.color_classifier = None
-        self.model_classifier = None
+        self.detector = load_detector(backend, model_path)
+        # Color and make/model classifiers, loaded on first use
+        self.classifier_backend = classifier_backend
+        self.classifier = None
 
     def _initialize_classifiers(self):
-        if self.color_classifier is None:
-            self.color_classifier = ColorClassifier()
-        if self.model_classifier is None:
-            self.model_classifier = ModelClassifier()
+        if self.classifier is None:
+            self.classifier = load_classifier(self.classifier_backend)
+
+    def warm_up(self, size=(640, 640)):
+        """
+        Load the classifiers and run a dummy inference through every model, so the first real image
+        doesn't pay for lazy initialization.
 
-    def _encode_image_base64(self, image):
+        Args:
+            size (tuple): (width, height) of the blank frame used for the warm-up pass.
         """
-        Encode an image as base64.
+        self._initialize_classifiers()
+        blank = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        self.detector.detect([blank])
+        self.classifier.predict(blank)
+
+    def _encode_image(self, image):
+        """
+        Encode an image in the configured format.
 
         Args:
             image (numpy.ndarray): The image to be encoded.
 
         Returns:
-            str: Base64-encoded image.
+            memoryview: The encoded image, a view of the encoder's output buffer rather than a copy of it.
         """
-        _, buffer = cv2.imencode('.jpg', image)
-        image_base64 = base64.b64encode(buffer).decode()
-        return image_base64
+        _, buffer = cv2.imencode(self._encode_extension, image, self._encode_params)
+        return buffer.data
 
     def _decode_image_base64(self, image_base64):
         """
@@ -83,79 +146,140 @@ class VehicleDetection:
         """
         image = self._decode_image_base64(image_base64)
         if image is not None:
-            return self.process_image(image)
+            return response_to_base64(self.process_image(image))
         else:
             return {
                 "error": "Failed to decode the base64 image"
             }
 
-    def process_image(self, image):
+    def process_image(self, image, fields=ALL_FIELDS, stall=None, top_k=1):
         """
         Process a single image to detect vehicles.
 
         Args:
-            image (numpy.ndarray): Input image for processing.
+            image (numpy.ndarray): Input BGR image for processing. Detection and classification cost grows with its
+                size, so callers that only need the detections should pass a downscaled frame.
+            fields (Iterable[str]): Which optional artifacts to compute, out of ALL_FIELDS. Artifacts that are not
+                requested are never encoded; their keys are None in the response or left out of each vehicle.
+            stall (tuple or None): (x_left, x_right) of the parking stall in the image. When given, detected
+                vehicles are sorted by the distance of their center to the center of the stall, and only the
+                `top_k` closest ones are run through the color and make/model classifiers; the others get None.
+            top_k (int): How many vehicles to classify when `stall` is given.
 
         Returns:
-            dict: Processed information including detected vehicles' details, the annotated image in base64, and the original image in base64.
+            dict: Processed information including detected vehicles' details, the annotated image and the original
+            image. Images are encoded in the configured format and returned as memoryviews; see response_to_base64.
+        """
+        return self.process_images([image], fields, [stall], top_k)[0]
+
+    def process_images(self, images, fields=ALL_FIELDS, stalls=None, top_k=1):
+        """
+        Process several images at once, running them through YOLO as a single batch.
+
+        Args:
+            images (list[numpy.ndarray]): Input BGR images for processing.
+            fields (Iterable[str]): Which optional artifacts to compute, see process_image.
+            stalls (list or None): The stall of each image (or None for an image without one), see process_image.
+            top_k (int): How many vehicles to classify in each image that has a stall.
+
+        Returns:
+            list[dict]: One response per input image, in the same order, shaped like the output of process_image.
+        """
+        fields = frozenset(fields)
+        unknown = fields - ALL_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        if stalls is None:
+            stalls = [None] * len(images)
+        if fields & {FIELD_COLOR, FIELD_MODEL}:
+            self._initialize_classifiers()
+        # Run the whole batch through YOLO in a single forward pass
+        results = self.detector.detect([self._increase_brightness(image) for image in images])
+        return [self._build_response(image, result, fields, stall, top_k)
+                for image, result, stall in zip(images, results, stalls)]
+
+    def _build_response(self, image, result, fields, stall=None, top_k=1):
+        """
+        Classify the vehicles YOLO found in an image and assemble the response for it.
+
+        Args:
+            image (numpy.ndarray): The image that was processed.
+            result (detectors.Detections): YOLO detection results for that image.
+            fields (frozenset[str]): Which optional artifacts to compute.
+            stall (tuple or None): (x_left, x_right) of the parking stall, see process_image.
+            top_k (int): How many of the vehicles closest to the stall to classify.
+
+        Returns:
+            dict: Processed information including detected vehicles' details, the annotated image and the original image.
         """
-        self._initialize_classifiers()
         response = {
             "number_of_vehicles_detected": 0,  # Counter for vehicles detected in this image
             "detected_vehicles": [],  # List of information about detected vehicles
-            "annotated_image_base64": None,  # Annotated image as a base64 encoded image
-            "original_image_base64": None  # Original image as a base64 encoded image
+            "annotated_image": None,  # Annotated image, encoded
+            "original_image": None  # Original image, encoded
         }
-        # Process a single image and return detection results, an annotated image, and the original image as base64.
-        results = self.model(self._increase_brightness(image))
-        if results is not None and len(results) > 0:
-            # Obtain bounding boxes (xywh format) of detected objects
-            boxes = results[0].boxes.xywh.cpu()
-            # Extract confidence scores for each detected object
-            conf_list = results[0].boxes.conf.cpu()
-            # Obtain the class labels (e.g., 'car', 'truck') for detected objects
-            clss = results[0].boxes.cls.cpu().tolist()
-            # Retrieve the names of the detected objects based on class labels
-            names = results[0].names
-
-            for box, cls, conf in zip(boxes, clss, conf_list):
-                x, y, w, h = box
-                label = str(names[cls])
-                # Bounding box plot
-                bbox_color = colors(cls, True)
-
-                # Increment the counter
-                response["number_of_vehicles_detected"] += 1
-
-                # Extract the frame of the detected vehicle
-                vehicle_frame = image[int(y - h / 2):int(y + h / 2), int(x - w / 2):int(x + w / 2)]
-                vehicle_frame_base64 = self._encode_image_base64(vehicle_frame)
-                color_info = self.color_classifier.predict(vehicle_frame)
-                color_info_json = json.dumps(color_info)
-                model_info = self.model_classifier.predict(vehicle_frame)
-                model_info_json = json.dumps(model_info)
-
-                # Add vehicle information to the response
-                response["detected_vehicles"].append({
-                    "vehicle_type": label,
-                    "detection_confidence": conf.item(),
-                    "vehicle_coordinates": {
-                        "x": x.item(),
-                        "y": y.item(),
-                        "width": w.item(),
-                        "height": h.item()
-                    },
-                    "vehicle_frame_base64": vehicle_frame_base64,
-                    "color_info": color_info_json,
-                    "model_info": model_info_json
-                })
-
-            annotated_image = results[0].plot()
-            annotated_image_base64 = self._encode_image_base64(annotated_image)
-            response["annotated_image_base64"] = annotated_image_base64
-
-        # Encode the original image as base64
-        original_image_base64 = self._encode_image_base64(image)
-        response["original_image_base64"] = original_image_base64
-
-        return response
\ No newline at end of file
+        # Obtain bounding boxes (xywh format) of detected objects
+        boxes = result.xywh
+        # Extract confidence scores for each detected object
+        conf_list = result.conf
+        # Obtain the class labels (e.g., 'car', 'truck') for detected objects
+        clss = result.cls.tolist()
+        # Retrieve the names of the detected objects based on class labels
+        names = result.names
+
+        n_classified = len(boxes)
+        if stall is not None:
+            # Rank the detections by how close they are to the center of the stall
+            stall_center = stall[0] + (stall[1] - stall[0]) / 2
+            order = np.argsort(np.abs(boxes[:, 0] - stall_center), kind="stable")
+            boxes, conf_list = boxes[order], conf_list[order]
+            clss = [clss[i] for i in order.tolist()]
+            n_classified = min(top_k, len(boxes))
+
+        # Extract the frame of every detected vehicle
+        vehicle_frames = [image[int(y - h / 2):int(y + h / 2), int(x - w / 2):int(x + w / 2)] for x, y, w, h in boxes]
+        # Classify the vehicles in the image at once, running only the classifiers that were asked for
+        color_infos, model_infos = [None] * len(vehicle_frames), [None] * len(vehicle_frames)
+        if n_classified and fields & {FIELD_COLOR, FIELD_MODEL}:
+            color_infos[:n_classified], model_infos[:n_classified] = self.classifier.predict_batch(
+                vehicle_frames[:n_classified], color=FIELD_COLOR in fields, model=FIELD_MODEL in fields)
+
+        for box, cls, conf, vehicle_frame, color_info, model_info in zip(boxes, clss, conf_list, vehicle_frames,
+                                                                         color_infos, model_infos):
+            x, y, w, h = box
+            label = str(names[cls])
+
+            # Increment the counter
+            response["number_of_vehicles_detected"] += 1
+
+            vehicle = {
+                "vehicle_type": label,
+                "detection_confidence": conf.item(),
+                "vehicle_coordinates": {
+                    "x": x.item(),
+                    "y": y.item(),
+                    "width": w.item(),
+                    "height": h.item()
+                },
+            }
+            if FIELD_CROPS in fields:
+                vehicle["vehicle_frame"] = self._encode_image(vehicle_frame)
+            if FIELD_COLOR in fields:
+                vehicle["color_info"] = json.dumps(color_info) if color_info is not None else None
+            if FIELD_MODEL in fields:
+                vehicle["model_info"] = json.dumps(model_info) if model_info is not None else None
+
+            # Add vehicle information to the response
+            response["detected_vehicles"].append(vehicle)
+
+        if FIELD_ANNOTATED in fields:
+            # Drawn on the input image itself, not the brightened copy YOLO saw
+            annotated_image = draw_detections(image.copy(), boxes.tolist(), [str(names[cls]) for cls in clss],
+                                              conf_list.tolist(), highlight=0 if stall is not None else None)
+            response["annotated_image"] = self._encode_image(annotated_image)
+
+        if FIELD_ORIGINAL in fields:
+            # Encode the original image
+            response["original_image"] = self._encode_image(image)
+
+        return response
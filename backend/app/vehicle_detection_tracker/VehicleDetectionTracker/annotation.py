@@ -0,0 +1,59 @@
+import zlib
+
+import cv2
+
+# Box colors (BGR), picked for each vehicle type by a stable hash of its label
+_PALETTE = [tuple(int(hex_color[i:i + 2], 16) for i in (4, 2, 0)) for hex_color in (
+    "FF3838", "FF701F", "FFB21D", "CFD231", "48F90A", "92CC17", "3DDB86", "1A9334", "00D4BB", "2C99A8",
+    "00C2FF", "344593", "6473FF", "0018EC", "8438FF", "520085", "CB38FF", "FF95C8", "FF37C7", "FF9D97",
+)]
+
+
+def label_color(label):
+    """
+    The box color of a vehicle type, the same on every image and in every process.
+
+    Args:
+        label (str): Vehicle type, e.g. "car".
+
+    Returns:
+        tuple: BGR color.
+    """
+    return _PALETTE[zlib.crc32(label.encode()) % len(_PALETTE)]
+
+
+def draw_detections(image, boxes, labels, confidences, highlight=None, line_width=None):
+    """
+    Draw vehicle detections on an image in place, in the style of ultralytics' Results.plot.
+
+    Args:
+        image (numpy.ndarray): BGR image to draw on.
+        boxes (Iterable): (x_center, y_center, width, height) of every detection, in pixels of `image`.
+        labels (Iterable[str]): Vehicle type of every detection.
+        confidences (Iterable[float]): Detection confidence of every detection.
+        highlight (int or None): Index of a detection to draw with a thicker box, e.g. the rated vehicle.
+        line_width (int or None): Box line width in pixels, scaled to the image size when not given.
+
+    Returns:
+        numpy.ndarray: `image`.
+    """
+    line_width = line_width or max(round(sum(image.shape[:2]) / 2 * 0.003), 2)
+    font_scale = line_width / 3
+    font_thickness = max(line_width - 1, 1)
+    for i, ((x, y, w, h), label, confidence) in enumerate(zip(boxes, labels, confidences)):
+        color = label_color(label)
+        top_left = (int(x - w / 2), int(y - h / 2))
+        bottom_right = (int(x + w / 2), int(y + h / 2))
+        thickness = line_width * 2 if i == highlight else line_width
+        cv2.rectangle(image, top_left, bottom_right, color, thickness, cv2.LINE_AA)
+
+        text = f"{label} {confidence:.2f}"
+        text_width, text_height = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, font_thickness)[0]
+        # Put the label above the box, or inside it when the box touches the top of the image
+        outside = top_left[1] - text_height - 3 >= 0
+        label_bottom = top_left[1] - text_height - 3 if outside else top_left[1] + text_height + 3
+        cv2.rectangle(image, top_left, (top_left[0] + text_width, label_bottom), color, -1, cv2.LINE_AA)
+        text_y = top_left[1] - 2 if outside else top_left[1] + text_height + 2
+        cv2.putText(image, text, (top_left[0], text_y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (255, 255, 255),
+                    font_thickness, cv2.LINE_AA)
+    return image
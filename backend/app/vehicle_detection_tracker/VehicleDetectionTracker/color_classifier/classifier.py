@@ -4,7 +4,9 @@ import os
 
 import cv2
 import numpy as np
-import tensorflow as tf
+
+from ..preprocessing import resize_and_pad_batch
+from ..runtime import OnnxGraph, onnx_path
 
 # In VehicleDetectionTracker/color_classifier/config.py
 model_file = "/vehicle_detection_tracker/VehicleDetectionTracker/" + "data/model-weights-spectrico-car-colors-mobilenet-224x224-052EAC82.pb"
@@ -34,6 +36,8 @@ def print_directory_tree(directory, level=0):
             print_directory_tree(path, level + 1)
 
 def load_graph(model_file):
+    # Imported here so the ONNX backend never loads TensorFlow
+    import tensorflow as tf
     # print out file tree to debug
     graph_def = tf.compat.v1.GraphDef()
     with open(model_file, "rb") as f:
@@ -89,34 +93,42 @@ def resizeAndPad(img, size, padColor=0):
     scaled_img = cv2.copyMakeBorder(scaled_img, pad_top, pad_bot, pad_left, pad_right, borderType=cv2.BORDER_CONSTANT, value=padColor)
     return scaled_img
 
+def top_classes(results, labels, top=3):
+    top_indices = results.argsort()[-top:][::-1]
+    classes = []
+    for ix in top_indices:
+        classes.append({"color": labels[ix], "prob": str(results[ix])})
+    return classes
+
 class Classifier:
-    def __init__(self):
+    def __init__(self, backend="tensorflow"):
         # uncomment the next 3 lines if you want to use CPU instead of GPU
         # import os
         # os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
         # os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-        self.graph = load_graph(model_file)
         self.labels = load_labels(label_file)
+        # The ONNX conversion of the graph (see runtime.convert_to_onnx) runs without TensorFlow
+        self.runtime = OnnxGraph(onnx_path(model_file)) if backend == "onnx" else None
+        if self.runtime is not None:
+            return
+        import tensorflow as tf
+        self.graph = load_graph(model_file)
         input_name = input_layer
         output_name = output_layer
         self.input_operation = self.graph.get_operation_by_name(input_name)
         self.output_operation = self.graph.get_operation_by_name(output_name)
+        # Keep one session for the lifetime of the classifier instead of opening one per prediction
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+        self.sess.graph.finalize()  # Graph is read-only after this statement.
 
     def predict(self, img):
-        img = img[:, :, ::-1]
-        img = resizeAndPad(img, classifier_input_size)
-        # Add a forth dimension since Tensorflow expects a list of images
-        img = np.expand_dims(img, axis=0)
-        # Scale the input image to the range used in the trained network
-        img = img.astype(np.float32)
-        img /= 127.5
-        img -= 1.
-        with tf.compat.v1.Session(graph=self.graph) as sess:
-            results = sess.run(self.output_operation.outputs[0], {self.input_operation.outputs[0]: img})
-        results = np.squeeze(results)
-        top = 3
-        top_indices = results.argsort()[-top:][::-1]
-        classes = []
-        for ix in top_indices:
-            classes.append({"color": self.labels[ix], "prob": str(results[ix])})
-        return classes
\ No newline at end of file
+        return self.predict_batch([img])[0]
+
+    def predict_batch(self, imgs):
+        """Classify a list of BGR vehicle crops with a single session run, returning the top 3 colors for each."""
+        batch = resize_and_pad_batch(imgs, classifier_input_size)
+        if self.runtime is not None:
+            results = self.runtime.run(batch)
+        else:
+            results = self.sess.run(self.output_operation.outputs[0], {self.input_operation.outputs[0]: batch})
+        return [top_classes(scores, self.labels) for scores in results]
@@ -0,0 +1,114 @@
+from .color_classifier import classifier as color_module
+from .model_classifier import classifier as model_module
+from .preprocessing import resize_and_pad_batch
+from .runtime import CLASSIFIER_BACKENDS, OnnxGraph, onnx_path
+
+
+def load_graph_def(model_file):
+    # Imported here so the ONNX backend never loads TensorFlow
+    import tensorflow as tf
+    with tf.io.gfile.GFile(model_file, 'rb') as f:
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+class CombinedClassifier:
+    """
+    Runs the color and the make/model classifiers together.
+
+    Both frozen MobileNet graphs are imported into a single finalized graph (under the "color/" and "model/"
+    name scopes) served by one long-lived session, so a batch of crops is classified by both networks in a
+    single `run` call, each fed at its own input size.
+    """
+
+    def __init__(self):
+        import tensorflow as tf
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(load_graph_def(color_module.model_file), name="color")
+            tf.import_graph_def(load_graph_def(model_module.model_file), name="model")
+
+        self.color_input = self.graph.get_tensor_by_name(f"color/{color_module.input_layer}:0")
+        self.color_output = self.graph.get_tensor_by_name(f"color/{color_module.output_layer}:0")
+        self.model_input = self.graph.get_tensor_by_name(f"model/{model_module.input_layer}:0")
+        self.model_output = self.graph.get_tensor_by_name(f"model/{model_module.output_layer}:0")
+
+        self.color_labels = color_module.load_labels(color_module.label_file)
+        self.model_labels = model_module.load_labels(model_module.label_file)
+
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+        self.sess.graph.finalize()  # Graph is read-only after this statement.
+
+    def predict_batch(self, imgs, color=True, model=True):
+        """
+        Classify a list of BGR vehicle crops.
+
+        Args:
+            imgs (list[numpy.ndarray]): Vehicle crops.
+            color (bool): Whether to run the color classifier.
+            model (bool): Whether to run the make/model classifier.
+
+        Returns:
+            tuple[list, list]: The top 3 colors and the top 3 makes/models for each crop, or a list of None
+            for a classifier that was not run.
+        """
+        fetches, feed_dict = [], {}
+        if color:
+            fetches.append(self.color_output)
+            feed_dict[self.color_input] = resize_and_pad_batch(imgs, color_module.classifier_input_size)
+        if model:
+            fetches.append(self.model_output)
+            feed_dict[self.model_input] = resize_and_pad_batch(imgs, model_module.classifier_input_size)
+        results = iter(self.sess.run(fetches, feed_dict=feed_dict) if fetches else [])
+
+        color_infos = [None] * len(imgs)
+        model_infos = [None] * len(imgs)
+        if color:
+            color_infos = [color_module.top_classes(scores, self.color_labels) for scores in next(results)]
+        if model:
+            model_infos = [model_module.top_classes(scores, self.model_labels) for scores in next(results)]
+        return color_infos, model_infos
+
+    def predict(self, img):
+        color_info, model_info = self.predict_batch([img])
+        return color_info[0], model_info[0]
+
+
+class OnnxCombinedClassifier(CombinedClassifier):
+    """
+    The color and make/model classifiers converted to ONNX (see runtime.convert_to_onnx), run with ONNX Runtime.
+    Same inputs and outputs as CombinedClassifier, without TensorFlow.
+    """
+
+    def __init__(self):
+        self.color_graph = OnnxGraph(onnx_path(color_module.model_file))
+        self.model_graph = OnnxGraph(onnx_path(model_module.model_file))
+        self.color_labels = color_module.load_labels(color_module.label_file)
+        self.model_labels = model_module.load_labels(model_module.label_file)
+
+    def predict_batch(self, imgs, color=True, model=True):
+        color_infos = [None] * len(imgs)
+        model_infos = [None] * len(imgs)
+        if color:
+            scores = self.color_graph.run(resize_and_pad_batch(imgs, color_module.classifier_input_size))
+            color_infos = [color_module.top_classes(row, self.color_labels) for row in scores]
+        if model:
+            scores = self.model_graph.run(resize_and_pad_batch(imgs, model_module.classifier_input_size))
+            model_infos = [model_module.top_classes(row, self.model_labels) for row in scores]
+        return color_infos, model_infos
+
+
+def load_classifier(backend="tensorflow"):
+    """
+    Create the combined color and make/model classifier.
+
+    Args:
+        backend (str): "tensorflow" for the frozen graphs, "onnx" for their ONNX conversions.
+
+    Returns:
+        CombinedClassifier or OnnxCombinedClassifier
+    """
+    if backend not in CLASSIFIER_BACKENDS:
+        raise ValueError(f"Unknown classifier backend: {backend}, expected one of {', '.join(CLASSIFIER_BACKENDS)}")
+    return OnnxCombinedClassifier() if backend == "onnx" else CombinedClassifier()
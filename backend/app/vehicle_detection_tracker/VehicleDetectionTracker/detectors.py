@@ -0,0 +1,212 @@
+import ast
+import os
+import shutil
+
+import cv2
+import numpy as np
+
+
+class Detections:
+    """
+    Objects found in one image, as numpy arrays in the pixel coordinates of that image.
+
+    Attributes:
+        xywh (numpy.ndarray): float32 array of shape (n, 4), the center, width and height of every box.
+        conf (numpy.ndarray): float32 array of shape (n,), the confidence of every box.
+        cls (numpy.ndarray): int array of shape (n,), the class index of every box.
+        names (dict): Class index to class name.
+    """
+
+    def __init__(self, xywh, conf, cls, names):
+        self.xywh = xywh
+        self.conf = conf
+        self.cls = cls
+        self.names = names
+
+    def __len__(self):
+        return len(self.xywh)
+
+
+class UltralyticsDetector:
+    """Runs a YOLO model through ultralytics and PyTorch, the reference every other backend is checked against."""
+
+    def __init__(self, model_path, conf=0.25, iou=0.7):
+        """
+        Args:
+            model_path (str): Path to the YOLO .pt model file.
+            conf (float): Minimum confidence of a detection.
+            iou (float): IoU above which non-maximum suppression drops the weaker of two boxes of the same class.
+        """
+        # Imported here so the other backends don't load PyTorch
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.conf = conf
+        self.iou = iou
+
+    def detect(self, images):
+        """
+        Detect objects in a batch of images.
+
+        Args:
+            images (list[numpy.ndarray]): BGR images of any size.
+
+        Returns:
+            list[Detections]: One per image, in the same order.
+        """
+        results = self.model(images, conf=self.conf, iou=self.iou, verbose=False)
+        return [Detections(result.boxes.xywh.cpu().numpy(), result.boxes.conf.cpu().numpy(),
+                           result.boxes.cls.cpu().numpy().astype(int), result.names)
+                for result in results]
+
+
+class OnnxDetector:
+    """
+    Runs a YOLO model exported to ONNX (see export_onnx) with ONNX Runtime on the CPU, reproducing the
+    ultralytics letterboxing, confidence filtering and class-aware non-maximum suppression around it.
+    """
+
+    def __init__(self, model_path, conf=0.25, iou=0.7, threads=0):
+        """
+        Args:
+            model_path (str): Path to the .onnx model file.
+            conf (float): Minimum confidence of a detection.
+            iou (float): IoU above which non-maximum suppression drops the weaker of two boxes of the same class.
+            threads (int): Intra-op threads for ONNX Runtime, 0 lets it decide.
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, width = model_input.shape
+        # Exports with fixed shapes take a fixed batch size, dynamic ones have a symbolic dimension here
+        self.batch_size = batch if isinstance(batch, int) else None
+        self.input_size = (height, width) if isinstance(height, int) else (640, 640)
+        # ultralytics stores the class names in the model metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadata["names"]) if "names" in metadata else {}
+        self.conf = conf
+        self.iou = iou
+
+    def _letterbox(self, image):
+        """Resize an image to fit the input size keeping its aspect ratio, and pad it the way ultralytics does."""
+        height, width = image.shape[:2]
+        input_height, input_width = self.input_size
+        gain = min(input_height / height, input_width / width)
+        new_width, new_height = round(width * gain), round(height * gain)
+        pad_x, pad_y = (input_width - new_width) / 2, (input_height - new_height) / 2
+        if (new_width, new_height) != (width, height):
+            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+        top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+        left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+        image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+        return image, gain, (left, top)
+
+    def _postprocess(self, output, gain, pad, image_shape):
+        # output is (4 + number of classes, number of candidate boxes)
+        output = output.T
+        scores = output[:, 4:]
+        cls = scores.argmax(axis=1)
+        conf = scores[np.arange(len(cls)), cls]
+        keep = conf > self.conf
+        xywh, conf, cls = output[keep, :4], conf[keep], cls[keep]
+        if len(xywh):
+            # Offset the boxes of every class so suppression never compares boxes of different classes
+            offset = cls[:, None] * 7680.0
+            corners = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2 + offset, xywh[:, 2:]], axis=1)
+            kept = cv2.dnn.NMSBoxes(corners.tolist(), conf.tolist(), self.conf, self.iou)
+            kept = np.asarray(kept, dtype=int).reshape(-1)
+            kept = kept[np.argsort(-conf[kept], kind="stable")]
+            xywh, conf, cls = xywh[kept], conf[kept], cls[kept]
+
+        # Map the boxes back to the original image, clipped to its bounds like ultralytics does
+        height, width = image_shape[:2]
+        x1 = np.clip((xywh[:, 0] - xywh[:, 2] / 2 - pad[0]) / gain, 0, width)
+        y1 = np.clip((xywh[:, 1] - xywh[:, 3] / 2 - pad[1]) / gain, 0, height)
+        x2 = np.clip((xywh[:, 0] + xywh[:, 2] / 2 - pad[0]) / gain, 0, width)
+        y2 = np.clip((xywh[:, 1] + xywh[:, 3] / 2 - pad[1]) / gain, 0, height)
+        xywh = np.stack([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1], axis=1).astype(np.float32)
+        return Detections(xywh, conf.astype(np.float32), cls.astype(int), self.names)
+
+    def detect(self, images):
+        """
+        Detect objects in a batch of images.
+
+        Args:
+            images (list[numpy.ndarray]): BGR images of any size.
+
+        Returns:
+            list[Detections]: One per image, in the same order.
+        """
+        letterboxed = [self._letterbox(image) for image in images]
+        # BGR HWC uint8 -> RGB CHW float in [0, 1]
+        batch = np.stack([padded for padded, _, _ in letterboxed])[..., ::-1].transpose(0, 3, 1, 2)
+        batch = np.ascontiguousarray(batch, dtype=np.float32) / np.float32(255)
+        step = self.batch_size or len(images)
+        outputs = []
+        for start in range(0, len(images), step):
+            chunk = batch[start:start + step]
+            if len(chunk) < step:
+                # fixed batch exports need a full batch, pad it with blank images
+                chunk = np.concatenate([chunk, np.zeros((step - len(chunk),) + chunk.shape[1:], np.float32)])
+            outputs.extend(self.session.run(None, {self.input_name: chunk})[0][:len(images) - start])
+        return [self._postprocess(output, gain, pad, image.shape)
+                for output, (_, gain, pad), image in zip(outputs, letterboxed, images)]
+
+
+BACKENDS = {
+    "ultralytics": UltralyticsDetector,
+    "onnx": OnnxDetector,
+}
+
+
+def load_detector(backend, model_path, **kwargs):
+    """
+    Create a detector.
+
+    Args:
+        backend (str): A key of BACKENDS.
+        model_path (str): Model file for that backend, a .pt file for "ultralytics" and a .onnx file for "onnx".
+        **kwargs: Passed on to the backend.
+
+    Returns:
+        UltralyticsDetector or OnnxDetector: Anything with a `detect(images) -> list[Detections]` method.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown detector backend: {backend}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend](model_path, **kwargs)
+
+
+def export_onnx(model_path, output_path=None, imgsz=640, batch=1, int8=False):
+    """
+    Export a YOLO model for OnnxDetector with a fixed input shape, optionally quantized to int8.
+
+    Args:
+        model_path (str): Path to the YOLO .pt model file.
+        output_path (str or None): Where to write the .onnx file, next to the .pt file when not given.
+        imgsz (int): Side of the square model input.
+        batch (int): Fixed batch size of the model input.
+        int8 (bool): Quantize the weights to int8 (dynamic quantization, no calibration data needed).
+
+    Returns:
+        str: Path of the written model.
+    """
+    from ultralytics import YOLO
+
+    exported = YOLO(model_path).export(format="onnx", imgsz=imgsz, batch=batch, dynamic=False, simplify=True)
+    if output_path is None:
+        output_path = os.path.splitext(model_path)[0] + ("-int8.onnx" if int8 else ".onnx")
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(exported, output_path, weight_type=QuantType.QUInt8)
+        # OnnxDetector reads the class names from the metadata, make sure quantizing kept it
+        import onnx
+        quantized = onnx.load(output_path)
+        if not quantized.metadata_props:
+            quantized.metadata_props.extend(onnx.load(exported).metadata_props)
+            onnx.save(quantized, output_path)
+    elif os.path.abspath(exported) != os.path.abspath(output_path):
+        shutil.move(exported, output_path)
+    return output_path
@@ -2,10 +2,12 @@
 # Licensed under the MIT License
 
 import numpy as np
-import tensorflow as tf
 import cv2
 import numpy as np
 
+from ..preprocessing import resize_and_pad_batch
+from ..runtime import OnnxGraph, onnx_path
+
 model_file = "/vehicle_detection_tracker/VehicleDetectionTracker/" + "data/model-weights-spectrico-mmr-mobilenet-128x128-344FF72B.pb"  # path to the car make and model classifier
 label_file = "/vehicle_detection_tracker/VehicleDetectionTracker/" + "data/model_labels.txt"  # path to the text file, containing list with the supported makes and models
 input_layer = "input_1"
@@ -14,6 +16,8 @@ classifier_input_size = (128, 128)  # input size of the classifier
 
 
 def load_graph(model_file):
+    # Imported here so the ONNX backend never loads TensorFlow
+    import tensorflow as tf
     with tf.io.gfile.GFile(model_file, 'rb') as f:
         graph_def = tf.compat.v1.GraphDef()
         graph_def.ParseFromString(f.read())
@@ -76,8 +80,17 @@ def resizeAndPad(img, size, padColor=0):
     return scaled_img
 
 
+def top_classes(results, labels, top=3):
+    top_indices = results.argsort()[-top:][::-1]
+    classes = []
+    for ix in top_indices:
+        make_model = labels[ix].split('\t')
+        classes.append({"make": make_model[0], "model": make_model[1], "prob": str(results[ix])})
+    return classes
+
+
 class Classifier():
-    def __init__(self):
+    def __init__(self, backend="tensorflow"):
         # uncomment the next 3 lines if you want to use CPU instead of GPU
         import os
         os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -88,10 +101,17 @@ class Classifier():
         self.input_operation = None
         self.output_operation = None
         self.sess = None
+        self.runtime = None
+        self.backend = backend
 
     def initialize(self):
-        self.graph = load_graph(model_file)
         self.labels = load_labels(label_file)
+        if self.backend == "onnx":
+            # The ONNX conversion of the graph (see runtime.convert_to_onnx) runs without TensorFlow
+            self.runtime = OnnxGraph(onnx_path(model_file))
+            return
+        import tensorflow as tf
+        self.graph = load_graph(model_file)
 
         self.input_operation = self.graph.get_operation_by_name(input_layer)
         self.output_operation = self.graph.get_operation_by_name(output_layer)
@@ -100,29 +120,18 @@ class Classifier():
         self.sess.graph.finalize()  # Graph is read-only after this statement.
 
     def predict(self, img):
-        if self.graph is None or self.labels is None:
+        return self.predict_batch([img])[0]
+
+    def predict_batch(self, imgs):
+        """Classify a list of BGR vehicle crops with a single session run, returning the top 3 makes/models for each."""
+        if self.labels is None:
             self.initialize()
 
-        img = img[:, :, ::-1]
-        img = resizeAndPad(img, classifier_input_size)
-
-        # Add a forth dimension since Tensorflow expects a list of images
-        img = np.expand_dims(img, axis=0)
-
-        # Scale the input image to the range used in the trained network
-        img = img.astype(np.float32)
-        img /= 127.5
-        img -= 1.
-
-        results = self.sess.run(self.output_operation.outputs[0], feed_dict={
-            self.input_operation.outputs[0]: img
-        })
-        results = np.squeeze(results)
-
-        top = 3
-        top_indices = results.argsort()[-top:][::-1]
-        classes = []
-        for ix in top_indices:
-            make_model = self.labels[ix].split('\t')
-            classes.append({"make": make_model[0], "model": make_model[1], "prob": str(results[ix])})
-        return classes
\ No newline at end of file
+        batch = resize_and_pad_batch(imgs, classifier_input_size)
+        if self.runtime is not None:
+            results = self.runtime.run(batch)
+        else:
+            results = self.sess.run(self.output_operation.outputs[0], feed_dict={
+                self.input_operation.outputs[0]: batch
+            })
+        return [top_classes(scores, self.labels) for scores in results]
@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+
+
+def resize_and_pad_batch(imgs, size):
+    """
+    Prepare a list of BGR vehicle crops as one classifier input batch.
+
+    Each crop is resized to fit `size` keeping its aspect ratio (the same geometry as resizeAndPad in the
+    classifier modules), converted to RGB and written into a preallocated NHWC buffer, which is then scaled
+    to the [-1, 1] range used by the MobileNet classifiers in a single vectorized pass.
+
+    Args:
+        imgs (list[numpy.ndarray]): BGR crops of arbitrary sizes.
+        size (tuple): (height, width) of the classifier input.
+
+    Returns:
+        numpy.ndarray: float32 array of shape (len(imgs), height, width, 3).
+    """
+    sh, sw = size
+    batch = np.zeros((len(imgs), sh, sw, 3), dtype=np.uint8)
+    for i, img in enumerate(imgs):
+        h, w = img.shape[:2]
+        if h == 0 or w == 0:
+            # degenerate crop, leave it as padding
+            continue
+        # interpolation method
+        if h > sh or w > sw:  # shrinking image
+            interp = cv2.INTER_AREA
+        else:  # stretching image
+            interp = cv2.INTER_CUBIC
+        # compute scaling and pad sizing
+        aspect = w / h
+        if aspect > 1:  # horizontal image
+            new_w = sw
+            new_h = int(np.round(new_w / aspect))
+        elif aspect < 1:  # vertical image
+            new_h = sh
+            new_w = int(np.round(new_h * aspect))
+        else:  # square image
+            new_h, new_w = sh, sw
+        top = (sh - new_h) // 2
+        left = (sw - new_w) // 2
+        # resizing is per channel, so flipping BGR -> RGB afterwards gives the same pixels
+        scaled_img = cv2.resize(img, (new_w, new_h), interpolation=interp)
+        batch[i, top:top + new_h, left:left + new_w] = scaled_img[:, :, ::-1]
+
+    # Scale the input images to the range used in the trained network
+    inputs = np.empty(batch.shape, dtype=np.float32)
+    np.divide(batch, np.float32(127.5), out=inputs)
+    inputs -= 1.
+    return inputs
@@ -0,0 +1,69 @@
+import os
+
+# Classifier runtimes: "tensorflow" runs the frozen .pb graphs, "onnx" runs the converted .onnx models with
+# ONNX Runtime and never imports TensorFlow
+CLASSIFIER_BACKENDS = ("tensorflow", "onnx")
+
+
+def onnx_path(model_file):
+    """
+    Where the ONNX conversion of a frozen graph is stored: next to it, with an .onnx extension.
+
+    Args:
+        model_file (str): Path to the frozen .pb graph.
+
+    Returns:
+        str: Path of the .onnx model.
+    """
+    return os.path.splitext(model_file)[0] + ".onnx"
+
+
+class OnnxGraph:
+    """A classifier converted with convert_to_onnx, run with ONNX Runtime on the CPU."""
+
+    def __init__(self, model_file):
+        """
+        Args:
+            model_file (str): Path to the .onnx model.
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, batch):
+        """
+        Args:
+            batch (numpy.ndarray): float32 NHWC input, as made by preprocessing.resize_and_pad_batch.
+
+        Returns:
+            numpy.ndarray: The softmax scores of every image in the batch.
+        """
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+def convert_to_onnx(model_file, input_layer, output_layer, opset=13):
+    """
+    Convert a frozen TensorFlow classifier graph to ONNX. This is the only step that needs TensorFlow (and
+    tf2onnx); it runs once, offline, and the result is written to onnx_path(model_file).
+
+    Args:
+        model_file (str): Path to the frozen .pb graph.
+        input_layer (str): Name of the input operation.
+        output_layer (str): Name of the output operation.
+        opset (int): ONNX opset to target.
+
+    Returns:
+        str: Path of the written .onnx model.
+    """
+    import tensorflow as tf
+    import tf2onnx
+
+    with tf.io.gfile.GFile(model_file, 'rb') as f:
+        graph_def = tf.compat.v1.GraphDef()
+        graph_def.ParseFromString(f.read())
+    output_path = onnx_path(model_file)
+    tf2onnx.convert.from_graph_def(graph_def, input_names=[f"{input_layer}:0"], output_names=[f"{output_layer}:0"],
+                                   opset=opset, output_path=output_path)
+    return output_path
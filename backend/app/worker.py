@@ -0,0 +1,94 @@
+import asyncio
+import os
+import traceback
+from datetime import datetime, timedelta, timezone as tz
+
+from fastapi import HTTPException
+from sqlalchemy import select, or_, and_
+from starlette.concurrency import run_in_threadpool
+
+import inference
+from database import AsyncSessionLocal, IngestJob, migrate_when_reachable, DB_MIGRATE_ON_STARTUP
+from posts import process_upload
+from storage import get_blob_store
+
+WORKER_BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", "8"))
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", "1"))  # seconds
+WORKER_JOB_TIMEOUT = int(os.environ.get("WORKER_JOB_TIMEOUT", "300"))  # seconds before a running job is retried
+WORKER_MAX_ATTEMPTS = int(os.environ.get("WORKER_MAX_ATTEMPTS", "3"))
+
+
+async def claim_jobs(batch_size: int) -> list[IngestJob]:
+    """
+    Mark up to `batch_size` jobs as running and return them. Jobs left running by a worker that died are
+    picked up again once they time out. SKIP LOCKED lets any number of workers claim jobs concurrently
+    without blocking on, or double-claiming, each other's rows.
+    """
+    stale = datetime.now(tz.utc) - timedelta(seconds=WORKER_JOB_TIMEOUT)
+    async with AsyncSessionLocal() as db:
+        jobs = (await db.scalars(
+            select(IngestJob)
+            .where(or_(IngestJob.status == "queued",
+                       and_(IngestJob.status == "running", IngestJob.updated_at < stale)))
+            .order_by(IngestJob.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )).all()
+        for job in jobs:
+            job.status = "running"
+            job.attempts += 1
+        await db.commit()
+        return jobs
+
+
+async def finish_job(job_id: int, **values):
+    async with AsyncSessionLocal() as db:
+        job = await db.get(IngestJob, job_id)
+        for name, value in values.items():
+            setattr(job, name, value)
+        await db.commit()
+
+
+async def delete_upload(upload_key: str):
+    """Delete a finished job's upload from the blob store. Every upload has a key of its own, see enqueue_upload."""
+    try:
+        await run_in_threadpool(get_blob_store().delete, upload_key)
+    except Exception:
+        # the job is finished either way, a leftover upload only costs space
+        traceback.print_exc()
+
+
+async def process_job(job: IngestJob):
+    try:
+        contents = await run_in_threadpool(get_blob_store().get, job.upload_key)
+        async with AsyncSessionLocal() as db:
+            post = await process_upload(db, job.user_id, contents)
+    except HTTPException as e:
+        # the upload itself was rejected, e.g. no vehicle in it, retrying won't help
+        await finish_job(job.id, status="failed", error=str(e.detail))
+        await delete_upload(job.upload_key)
+        return
+    except Exception:
+        traceback.print_exc()
+        # retry until the job has used up its attempts
+        status = "failed" if job.attempts >= WORKER_MAX_ATTEMPTS else "queued"
+        await finish_job(job.id, status=status, error=traceback.format_exc(limit=1))
+        if status == "failed":
+            await delete_upload(job.upload_key)
+        return
+    await finish_job(job.id, status="done", post_id=post["id"], score=post["score"],
+                     plate_number=post["plate_number"], error=None)
+    await delete_upload(job.upload_key)
+
+
+async def run(batch_size: int = WORKER_BATCH_SIZE, poll_interval: float = WORKER_POLL_INTERVAL):
+    """Process ingest jobs forever. The jobs of a batch run concurrently, so their images share model batches."""
+    if DB_MIGRATE_ON_STARTUP:
+        await migrate_when_reachable()
+    await inference.warm_up()
+    while True:
+        jobs = await claim_jobs(batch_size)
+        if not jobs:
+            await asyncio.sleep(poll_interval)
+            continue
+        await asyncio.gather(*(process_job(job) for job in jobs))